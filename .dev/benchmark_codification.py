@@ -0,0 +1,63 @@
+import os
+import sys
+from time import perf_counter
+import numpy as np
+from pandas import DataFrame
+
+# use the repository modules instead of the copies in .dev/modules
+working_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, working_dir)
+
+from modules.custom_functions import loadLocalJsonDoc, codifyServices, processMultValueColumns  # noqa: E402
+
+
+def getKoboExport(size: int, codify_dict: dict, seed: int = 0):
+    """
+    return a synthetic Kobo export with a space-separated multi-select answer per configured column
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for current in codify_dict.values():
+        tokens = list(current["values_dict"].values()) + ["desconocido"]
+        # a few hundred distinct answer combinations, like a real survey
+        answers = [" ".join(rng.choice(tokens, size=rng.integers(1, 4), replace=False))
+                   for _ in range(300)] + [np.nan]
+        data[current["target_column"]] = np.array(answers, dtype=object)[
+            rng.integers(0, len(answers), size=size)]
+    return DataFrame(data)
+
+
+def processMultValueColumnsRowWise(df: DataFrame, codify_dict: dict):
+    """
+    previous implementation, applying codifyServices row by row
+    """
+    for current in codify_dict.values():
+        reversed_values_dict = dict([(x[1], x[0])
+                                    for x in current["values_dict"].items()])
+        df[current["output_column"]] = df[current["target_column"]].apply(
+            lambda x: codifyServices(x, reversed_values_dict, str(current["other_value"])))
+    return df
+
+
+def main(size: int = 1000000):
+    codify_dict = loadLocalJsonDoc(os.path.join(
+        working_dir, "defaults/codification_dict.json"))
+    df = getKoboExport(size, codify_dict)
+
+    start = perf_counter()
+    expected = processMultValueColumnsRowWise(df.copy(), codify_dict)
+    row_wise = perf_counter() - start
+
+    start = perf_counter()
+    output = processMultValueColumns(df.copy(), codify_dict)
+    vectorized = perf_counter() - start
+
+    output_columns = [current["output_column"]
+                      for current in codify_dict.values()]
+    assert expected[output_columns].equals(output[output_columns])
+    print(f"rows: {size}, columns: {len(output_columns)}")
+    print(f"row-wise: {row_wise:.2f}s, vectorized: {vectorized:.2f}s, speedup: {row_wise / vectorized:.1f}x")
+
+
+if (__name__ == "__main__"):
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,111 @@
+import os
+import sys
+import resource
+import subprocess
+import tempfile
+import importlib.util
+from argparse import ArgumentParser
+import numpy as np
+from pandas import DataFrame
+
+working_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def getServicesExport(size: int, width: int = 60, seed: int = 0):
+    """
+    return a synthetic service export with `width` text columns
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.array(["otra", "acnur", "oim", "unicef", "si", "no", np.nan],
+                      dtype=object)
+    return DataFrame({f"col_{i}": labels[rng.integers(0, len(labels), size=size)]
+                      for i in range(width)})
+
+
+def getBaselineRevision():
+    """
+    return the first commit of the repository, whose transformation helpers deep copied their input
+    """
+    return subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=working_dir,
+                          capture_output=True, text=True, check=True).stdout.split()[0]
+
+
+def loadFunctions(variant: str, revision: str):
+    """
+    return custom_functions module of the working tree ("current") or of a git revision ("baseline")
+    """
+    if (variant == "current"):
+        sys.path.insert(0, working_dir)
+        from modules import custom_functions
+        return custom_functions
+    source = subprocess.run(["git", "show", f"{revision}:modules/custom_functions.py"], cwd=working_dir,
+                            capture_output=True, text=True, check=True).stdout
+    filepath = os.path.join(tempfile.mkdtemp(), "baseline_custom_functions.py")
+    with open(file=filepath, mode='w', encoding='utf-8') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location(
+        "baseline_custom_functions", filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def getPeakRss():
+    """
+    return peak resident set size of the process in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def runVariant(variant: str, size: int, steps: int, revision: str):
+    """
+    print peak RSS before and after running `steps` transformations, reassigning the frame like the process scripts do
+    """
+    functions = loadFunctions(variant, revision)
+    df = getServicesExport(size)
+    before = getPeakRss()
+    for step in range(steps):
+        df = functions.replaceOrganisation(df, "otra", "col_0", "col_1")
+        df = functions.processValueReplacement(
+            df, {"col_2": {"si": "Sí", "no": "No"}})
+        df = functions.capitaliseColumns(df, ["col_3"])
+    print(f"{before:.0f} {getPeakRss():.0f}")
+
+
+def measure(variant: str, size: int, steps: int, revision: str):
+    """
+    return peak RSS in megabytes of a fresh interpreter before and after the steps of a variant
+    """
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--variant", variant, "--size", str(size),
+                             "--steps", str(steps), "--revision", revision], capture_output=True, text=True, check=True).stdout
+    before, after = output.split()[-2:]
+    return float(before), float(after)
+
+
+def main(size: int, revision: str):
+    print(f"rows: {size}, columns: 60, baseline: {revision[:7]}")
+    for steps in [1, 2, 4, 8]:
+        results = []
+        for variant in ["baseline", "current"]:
+            before, after = measure(variant, size, steps, revision)
+            results.append(
+                f"{variant}: {after:.0f} MB peak RSS (+{after - before:.0f} MB)")
+        print(f"steps: {steps}, " + ", ".join(results))
+
+
+if (__name__ == "__main__"):
+    parser = ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    parser.add_argument("--steps", type=int, default=0)
+    parser.add_argument("--variant", type=str, default="",
+                        choices=["", "baseline", "current"])
+    parser.add_argument("--revision", type=str, default="",
+                        help="git revision of the baseline implementation, the first commit if not given")
+    args = parser.parse_args()
+    revision = args.revision or getBaselineRevision()
+    if (args.variant):
+        runVariant(args.variant, args.size, args.steps, revision)
+    else:
+        main(args.size, revision)
@@ -0,0 +1,273 @@
+import os
+import json
+import sqlite3
+import threading
+from time import time, strftime
+import numpy as np
+import shapely
+from pandas import DataFrame, Series, Index, read_parquet
+from pandas.util import hash_pandas_object
+from geopandas.array import GeometryDtype
+
+default_cache_dir = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), ".cache")
+default_cache_path = os.path.join(default_cache_dir, "reverse_geocode.sqlite")
+
+# 180 days
+default_ttl = 180 * 24 * 60 * 60
+default_max_entries = 500000
+default_precision = 5
+# cache hits whose access time is kept in memory before it is written in a single transaction
+default_access_batch = 10000
+
+
+def getCoordinateKey(longitude: float, latitude: float, precision: int = default_precision):
+    """
+    return a string key for a coordinate pair rounded to a given number of decimals
+    """
+    return f"{round(float(longitude), precision):.{precision}f},{round(float(latitude), precision):.{precision}f}"
+
+
+class GeocodeCache:
+    """
+    Persistent key/value store for reverse geocoded results, backed by SQLite.
+
+    Parameters
+    ----------
+    filepath: (optional) location of the cache file. Defaults to `GEOCODE_CACHE_PATH` or `.cache/reverse_geocode.sqlite`
+    precision: (optional) number of decimals the coordinates are rounded to when building keys
+    ttl: (optional) seconds after which an entry is considered stale. Use 0 to never expire entries
+    max_entries: (optional) maximum number of entries kept, least recently used entries are evicted first
+    access_batch: (optional) number of cache hits after which their access times are written, they are also written before evicting and on close
+    """
+
+    def __init__(self, filepath: str = "", precision: int = default_precision, ttl: int = default_ttl, max_entries: int = default_max_entries, access_batch: int = default_access_batch):
+        self.filepath = filepath or os.environ.get(
+            "GEOCODE_CACHE_PATH", default_cache_path)
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.access_batch = access_batch
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._accessed: dict[str, float] = {}
+        directory = os.path.dirname(self.filepath)
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(
+            self.filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS geocode_accessed_at ON geocode (accessed_at)")
+        self._connection.commit()
+
+    def getKey(self, longitude: float, latitude: float):
+        return getCoordinateKey(longitude, latitude, self.precision)
+
+    def get(self, longitude: float, latitude: float):
+        """
+        return cached result for coordinates, or None when missing or expired
+        """
+        key = self.getKey(longitude, latitude)
+        now = time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at FROM geocode WHERE key = ?", (key,)).fetchone()
+            if (row is None):
+                return None
+            value, created_at = row
+            if (self.ttl and now - created_at > self.ttl):
+                # expired entries are replaced by `set` or removed by `evict`
+                return None
+            self._accessed[key] = now
+            if (len(self._accessed) >= self.access_batch):
+                self._writeAccessed()
+        return json.loads(value)
+
+    def _writeAccessed(self):
+        if (len(self._accessed) == 0):
+            return
+        self._connection.executemany("UPDATE geocode SET accessed_at = ? WHERE key = ?",
+                                     [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+        self._connection.commit()
+        self._accessed = {}
+
+    def set(self, longitude: float, latitude: float, value: dict):
+        """
+        store result for coordinates
+        """
+        key = self.getKey(longitude, latitude)
+        now = time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO geocode (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            self._connection.commit()
+            self._accessed.pop(key, None)
+            self._writes += 1
+            if (self._writes % 1000 == 0):
+                self._evict()
+
+    def _evict(self):
+        # least recently used entries are found from up to date access times
+        self._writeAccessed()
+        if (self.ttl):
+            self._connection.execute(
+                "DELETE FROM geocode WHERE created_at < ?", (time() - self.ttl,))
+        if (self.max_entries):
+            self._connection.execute(
+                "DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._connection.commit()
+
+    def evict(self):
+        """
+        remove expired entries and entries above the size limit
+        """
+        with self._lock:
+            self._evict()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
+
+
+class GeocodeJournal:
+    """
+    Append-only journal of reverse geocoded results of a single pipeline run, used to resume interrupted runs.
+
+    Every result is written to a JSON lines file as soon as it arrives, keyed by its rounded coordinates
+    (the keys of `GeocodeCache`), so entries stay valid when rows are added to or reordered in the input.
+    The journal is removed by `complete` once the run has geocoded every coordinate. A journal left by an
+    interrupted run is never truncated: without `resume` it is kept under a timestamped name.
+
+    Parameters
+    ----------
+    name: name of the run, used as the journal file name
+    resume: (optional) keep the entries of a previous run instead of starting an empty journal
+    directory: (optional) location of journal files
+    precision: (optional) number of decimals the coordinates are rounded to when building keys
+    """
+
+    def __init__(self, name: str, resume: bool = False, directory: str = default_cache_dir, precision: int = default_precision):
+        os.makedirs(directory, exist_ok=True)
+        self.filepath = os.path.join(directory, f"journal_{name}.jsonl")
+        self.precision = precision
+        self.entries = {}
+        self._lock = threading.Lock()
+        if (resume and os.path.exists(self.filepath)):
+            with open(file=self.filepath, mode='r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line can be incomplete if the run was interrupted while writing
+                        continue
+                    self.entries[self.getKey(
+                        entry["lon"], entry["lat"])] = entry["result"]
+            print(f"{len(self.entries)} entries loaded from {self.filepath}")
+        elif (os.path.exists(self.filepath) and os.path.getsize(self.filepath) > 0):
+            kept_path = os.path.join(
+                directory, f"journal_{name}.{strftime('%Y%m%dT%H%M%S')}.jsonl")
+            os.replace(self.filepath, kept_path)
+            print(
+                f"journal of an interrupted run kept as {kept_path}, rename it to {self.filepath} and use --resume to continue it")
+        self._file = open(file=self.filepath, mode='a', encoding='utf-8')
+
+    def getKey(self, longitude: float, latitude: float):
+        return getCoordinateKey(longitude, latitude, self.precision)
+
+    def get(self, longitude: float, latitude: float):
+        """
+        return journaled result for coordinates, or None when they are missing
+        """
+        return self.entries.get(self.getKey(longitude, latitude))
+
+    def append(self, longitude: float, latitude: float, result: dict):
+        """
+        write result to the journal
+        """
+        entry = {"lon": longitude, "lat": latitude, "result": result}
+        with self._lock:
+            self.entries[self.getKey(longitude, latitude)] = result
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def complete(self):
+        """
+        close and remove the journal once every coordinate of the run is geocoded
+        """
+        self.close()
+        if (os.path.exists(self.filepath)):
+            os.remove(self.filepath)
+
+
+def getRowHashes(df: DataFrame):
+    """
+    return uint64 hash of every row of a DataFrame, stable between runs.
+
+    Columns are hashed in name order and geometries by their WKB, so the hash only changes when a value changes.
+    """
+    columns = {}
+    for column in sorted(df.columns):
+        values = df[column]
+        columns[column] = shapely.to_wkb(values.array) if isinstance(
+            values.dtype, GeometryDtype) else values.to_numpy()
+    return hash_pandas_object(DataFrame(columns), index=False).to_numpy()
+
+
+class UploadManifest:
+    """
+    Record of the row hashes of the last upload to a table, used to upload only inserted and changed rows.
+
+    The manifest is a parquet file of keys and row hashes, replaced only once an upload has finished.
+
+    Parameters
+    ----------
+    destination: table the rows are uploaded to, used as the manifest file name
+    directory: (optional) location of manifest files
+    """
+
+    def __init__(self, destination: str, directory: str = default_cache_dir):
+        os.makedirs(directory, exist_ok=True)
+        name = "".join([x if x.isalnum() else "_" for x in destination])
+        self.filepath = os.path.join(directory, f"manifest_{name}.parquet")
+
+    def exists(self):
+        return os.path.exists(self.filepath)
+
+    def load(self):
+        """
+        return Series of row hashes indexed by key, empty when nothing was uploaded yet
+        """
+        if (not self.exists()):
+            return Series([], dtype="uint64", index=Index([], dtype=object))
+        manifest = read_parquet(self.filepath)
+        return Series(manifest["hash"].to_numpy(), index=Index(manifest["key"].to_numpy(dtype=object)))
+
+    def getChanges(self, keys: Series, hashes: np.ndarray):
+        """
+        return boolean array of the rows that are new or changed since the last upload and the list of keys that were removed
+        """
+        previous = self.load()
+        keys = keys.astype(str)
+        positions = previous.index.get_indexer(keys)
+        known = positions >= 0
+        changed = ~known
+        changed[known] = previous.to_numpy()[positions[known]] != hashes[known]
+        removed = previous.index.difference(Index(keys)).tolist()
+        return changed, removed
+
+    def save(self, keys: Series, hashes: np.ndarray):
+        DataFrame({"key": keys.astype(str).to_numpy(), "hash": hashes}).to_parquet(
+            self.filepath, index=False)
@@ -0,0 +1,135 @@
+import io
+import csv
+import numpy as np
+from pandas import DataFrame, read_csv, to_numeric
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from .custom_defaults import defaults_dir, getDefaultsRegistry
+
+# same values pandas.read_csv reads as missing
+default_null_values = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+                       "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+# same values pandas.read_csv reads as booleans
+true_values = ["True", "TRUE", "true"]
+false_values = ["False", "FALSE", "false"]
+
+
+def loadSchema(filename: str = "aurora_schema.json", directory: str = defaults_dir):
+    """
+    return dictionary of column names and their type from a schema file in `defaults`, validated when it is loaded
+    """
+    return getDefaultsRegistry(directory).get(filename)
+
+
+def getHeader(filepath: str, sep: str = ",", encoding: str = "utf-8"):
+    """
+    return column names of a csv file and the byte offset where its first row starts.
+
+    Repeated names get a ".1", ".2"... suffix like pandas.read_csv, and names may contain quoted line breaks.
+    """
+    with open(file=filepath, mode='rb') as f:
+        raw = b""
+        quotes = 0
+        while True:
+            line = f.readline()
+            raw += line
+            quotes += line.count(b'"')
+            # the header ends at the first line break outside quotes
+            if (not line or quotes % 2 == 0):
+                break
+    # a utf-8 byte order mark is not part of the first column name
+    header_encoding = "utf-8-sig" if encoding.lower() in ["utf-8", "utf8"] else encoding
+    header = next(csv.reader(io.StringIO(
+        raw.decode(header_encoding), newline=''), delimiter=sep))
+    output = []
+    counts = {}
+    for column in header:
+        name = column
+        while (name in counts):
+            counts[column] += 1
+            name = f"{column}.{counts[column]}"
+        counts[name] = 0
+        output.append(name)
+    return output, len(raw)
+
+
+def getArrowOptions(header: list[str], schema: dict[str, str], only_schema: bool = True, sep: str = ",", encoding: str = "utf-8"):
+    """
+    return read, parse and convert options of the rows of a csv file reading every column as text
+    """
+    columns = [column for column in header if column in schema or not only_schema]
+    read_options = pa_csv.ReadOptions(column_names=header, encoding=encoding)
+    parse_options = pa_csv.ParseOptions(delimiter=sep, newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(
+        column_types={column: pa.string() for column in columns},
+        include_columns=columns,
+        null_values=default_null_values,
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=True)
+    return read_options, parse_options, convert_options
+
+
+def openRows(filepath: str, offset: int):
+    """
+    return binary file positioned at the first row of a csv file
+    """
+    f = open(file=filepath, mode='rb')
+    f.seek(offset)
+    return f
+
+
+def applySchemaTypes(df: DataFrame, schema: dict[str, str]):
+    """
+    return DataFrame of text columns converted to the types of the schema.
+
+    "string" columns are kept as text with NaN for missing values, "number" columns become bool when every
+    value is a pandas.read_csv boolean, int64 or float64 when every value is numeric and stay text otherwise,
+    as pandas.read_csv would infer them, and "Int64" columns become nullable integers. Columns that are not
+    in the schema are kept as text.
+    """
+    for column in df.columns:
+        values = df[column]
+        values = values.where(values.notna(), np.nan)
+        type = schema.get(column, "string")
+        if (type == "number"):
+            present = values.dropna()
+            if (len(present) > 0 and present.isin(true_values + false_values).all()):
+                # booleans with missing values stay an object column, like pandas.read_csv
+                values = values.map(
+                    lambda x: x in true_values if isinstance(x, str) else x)
+                if (values.notna().all()):
+                    values = values.astype(bool)
+            else:
+                try:
+                    values = to_numeric(values)
+                except (ValueError, TypeError):
+                    pass
+        elif (type == "Int64"):
+            values = to_numeric(values).astype("Int64")
+        df[column] = values
+    return df
+
+
+def readCsvWithSchema(filepath: str, schema: dict[str, str], only_schema: bool = False, sep: str = ",", encoding: str = "utf-8"):
+    """
+    return DataFrame of a csv file read with the multithreaded arrow csv reader and typed with a schema, see `applySchemaTypes`.
+
+    Parameters
+    ----------
+    filepath: file location of the csv file, https file endpoints are read with pandas.read_csv
+    schema: dictionary of column names and their type
+    only_schema: (optional) when True, columns that are not in the schema are not read
+    sep: (optional) column delimiter
+    encoding: (optional) file encoding
+    """
+    if (filepath.startswith(("http://", "https://"))):
+        df = read_csv(filepath, sep=sep, encoding=encoding)
+        return df[[column for column in df.columns if column in schema]] if only_schema else df
+    header, offset = getHeader(filepath, sep, encoding)
+    read_options, parse_options, convert_options = getArrowOptions(
+        header, schema, only_schema=only_schema, sep=sep, encoding=encoding)
+    with openRows(filepath, offset) as f:
+        table = pa_csv.read_csv(f, read_options=read_options,
+                                parse_options=parse_options, convert_options=convert_options)
+    return applySchemaTypes(table.to_pandas(), schema)
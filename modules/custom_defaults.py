@@ -0,0 +1,219 @@
+import os
+import json
+import atexit
+import pickle
+import hashlib
+import threading
+from pandas import DataFrame
+
+defaults_dir = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), "defaults")
+default_cache_path = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), ".cache", "defaults.pickle")
+
+# bumped when validators or compilers change, so that older caches are ignored
+cache_version = 2
+
+# type of the top level value of each defaults file
+document_types = {
+    "aurora_column_name.json": dict,
+    "aurora_schema.json": dict,
+    "codification_dict.json": dict,
+    "column_capitalisation.json": list,
+    "countries.json": list,
+    "countries_dict.json": dict,
+    "country_aliases.json": dict,
+    "country_column_dict.json": dict,
+    "feedback_values.json": dict,
+    "organisation_names.json": dict,
+    "places.json": dict,
+    "rename_columns.json": dict,
+    "services_plan.json": dict,
+    "test_user_ids.json": list,
+    "user_ids_ch.json": list,
+    "user_ids_col.json": list,
+    "value_replacements.json": dict,
+}
+
+user_id_documents = ["test_user_ids.json",
+                     "user_ids_ch.json", "user_ids_col.json"]
+
+# column types of csv schema documents, files named `*_schema.json`
+schema_types = ["string", "number", "Int64"]
+
+
+def validateDocument(filename: str, document):
+    """
+    raise ValueError when a defaults document does not have the structure the scripts expect
+    """
+    expected = document_types.get(filename)
+    if (expected is not None and not isinstance(document, expected)):
+        raise ValueError(
+            f"{filename} should contain a {expected.__name__}, found {type(document).__name__}")
+    if (filename in user_id_documents):
+        invalid = [x for x in document if type(x) != int]
+        if (len(invalid) > 0):
+            raise ValueError(
+                f"{filename} should only contain integer user ids, found {invalid[:5]}")
+    elif (filename == "countries.json"):
+        for record in document:
+            missing = [x for x in ["name", "iso_a2", "iso_a3", "x", "y"]
+                       if x not in record]
+            if (len(missing) > 0):
+                raise ValueError(
+                    f"{filename} record {record} is missing {missing}")
+    elif (filename == "codification_dict.json"):
+        for key, config in document.items():
+            missing = [x for x in ["target_column", "output_column", "values_dict", "other_value"]
+                       if x not in config]
+            if (len(missing) > 0):
+                raise ValueError(
+                    f"{filename} configuration {key} is missing {missing}")
+    elif (filename.endswith("_schema.json")):
+        invalid = {column: type for column, type in document.items()
+                   if type not in schema_types}
+        if (len(invalid) > 0):
+            raise ValueError(
+                f"{filename} has unknown column types {invalid}")
+    elif (filename == "feedback_values.json"):
+        invalid = [key for key, value in document.items()
+                   if not isinstance(value, dict)]
+        if (len(invalid) > 0):
+            raise ValueError(
+                f"{filename} lookup tables {invalid} should be objects")
+    elif (filename == "services_plan.json"):
+        if (not isinstance(document.get("steps"), list)):
+            raise ValueError(f"{filename} should have a list of steps")
+
+
+def compileDocument(filename: str, document):
+    """
+    return structure derived from a defaults document: sets of user ids and the DataFrame of countries
+    """
+    if (filename in user_id_documents):
+        return frozenset(document)
+    if (filename == "countries.json"):
+        return DataFrame.from_records(document)
+    return document
+
+
+def getFileHash(filepath: str):
+    with open(file=filepath, mode='rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class DefaultsRegistry:
+    """
+    Process wide registry of the documents of the `defaults` directory.
+
+    Each document is read, validated and compiled once per process, and its compiled form is kept in a
+    pickle cache so that later runs skip json parsing. A cached document is reused while the file keeps
+    the same modification time and size, or the same content hash when only its modification time changed.
+    Returned documents are shared and must not be changed.
+
+    Parameters
+    ----------
+    directory: (optional) location of the defaults files, independent of the working directory
+    cache_path: (optional) location of the pickle cache, an empty string disables it
+    """
+
+    def __init__(self, directory: str = defaults_dir, cache_path: str = default_cache_path):
+        self.directory = directory
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._entries = self._loadCache()
+        self._loaded = {}
+        self._changed = False
+        # documents parsed during the run are cached once, when the process ends
+        atexit.register(self.save)
+
+    def _loadCache(self):
+        if (not self.cache_path or not os.path.exists(self.cache_path)):
+            return {}
+        try:
+            with open(file=self.cache_path, mode='rb') as f:
+                cache = pickle.load(f)
+        except Exception:
+            # an unreadable cache is rebuilt
+            return {}
+        if (cache.get("version") != cache_version or cache.get("directory") != self.directory):
+            return {}
+        return cache["entries"]
+
+    def save(self):
+        """
+        write the pickle cache when a document was parsed since it was last written
+        """
+        with self._lock:
+            if (not self._changed or not self.cache_path):
+                return
+            self._changed = False
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temporary_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(file=temporary_path, mode='wb') as f:
+            pickle.dump({"version": cache_version, "directory": self.directory,
+                        "entries": self._entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.cache_path)
+
+    def _getEntry(self, filename: str):
+        if (filename in self._loaded):
+            return self._loaded[filename]
+        filepath = os.path.join(self.directory, filename)
+        stat = os.stat(filepath)
+        entry = self._entries.get(filename)
+        if (entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size):
+            file_hash = getFileHash(filepath)
+            if (entry is None or entry["hash"] != file_hash):
+                with open(file=filepath, mode='r', encoding='utf-8') as f:
+                    document = json.load(f)
+                validateDocument(filename, document)
+                entry = {"hash": file_hash, "document": document,
+                         "compiled": compileDocument(filename, document)}
+            entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+            self._entries[filename] = entry
+            self._changed = True
+        self._loaded[filename] = entry
+        return entry
+
+    def get(self, filename: str, dataProp: str = ""):
+        """
+        return deserialised defaults document, or one of its properties
+        """
+        with self._lock:
+            document = self._getEntry(filename)["document"]
+        return document[dataProp] if dataProp else document
+
+    def getCompiled(self, filename: str):
+        """
+        return structure compiled from a defaults document, see `compileDocument`
+        """
+        with self._lock:
+            compiled = self._getEntry(filename)["compiled"]
+        return compiled
+
+
+_registries = {}
+
+
+def getDefaultsRegistry(directory: str = defaults_dir):
+    """
+    return the registry of a defaults directory, created once per process
+    """
+    if (directory not in _registries):
+        cache_path = default_cache_path if directory == defaults_dir else ""
+        _registries[directory] = DefaultsRegistry(directory, cache_path)
+    return _registries[directory]
+
+
+def loadDefault(filename: str, dataProp: str = ""):
+    """
+    return deserialised document of the `defaults` directory, or one of its properties
+    """
+    return getDefaultsRegistry().get(filename, dataProp)
+
+
+def loadCompiledDefault(filename: str):
+    """
+    return structure compiled from a document of the `defaults` directory, e.g. the set of ids of `test_user_ids.json`
+    """
+    return getDefaultsRegistry().getCompiled(filename)
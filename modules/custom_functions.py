@@ -1,8 +1,9 @@
-from pandas import DataFrame, Series
-from copy import deepcopy
+from pandas import DataFrame, Series, SparseDtype
 from datetime import datetime, timezone
 import json
 import re
+import unicodedata
+import numpy as np
 from tqdm import tqdm
 
 default_missing_value = 999999
@@ -99,22 +100,137 @@ def codifyServices(value: str, values_dict: dict[str, int], otherValue: str):
     return "|".join(output)
 
 
-def processColumn(dfColumn: Series, values_dict: dict[int, str], other_value: str):
+def getReversedValuesDict(values_dict: dict[int, str]):
     """
-    return a column that has processed codified values
+    return dictionary of answer token to code
     """
-    reversed_values_dict = dict([(x[1], x[0]) for x in values_dict.items()])
-    return dfColumn.apply(lambda x: codifyServices(x, reversed_values_dict, other_value))
+    return dict([(x[1], str(x[0])) for x in values_dict.items()])
 
 
-def processMultValueColumns(df: DataFrame, columnObjectsList: dict[dict]):
+def getAnswerTokens(dfColumn: Series):
+    """
+    return factorized codes of a multi-select column, number of unique answers and
+    the space-separated tokens of every text answer indexed by the position of its unique answer
+    """
+    codes, uniques = dfColumn.factorize(use_na_sentinel=True)
+    uniques = Series(np.asarray(uniques, dtype=object))
+    is_text = uniques.map(type) == str
+    tokens = uniques[is_text].str.split(" ").explode()
+    return codes, len(uniques), tokens
+
+
+def processColumn(dfColumn: Series, values_dict: dict[int, str], other_value: str, reversed_values_dict: dict[str, str] = None):
+    """
+    return a column that has processed codified values.
+
+    Answers are codified once per unique value: unique answers are split into tokens,
+    exploded, mapped to their codes and joined back with "|", then taken back to the rows.
+    Produces the same output as applying `codifyServices` to every row.
+    """
+    if (reversed_values_dict is None):
+        reversed_values_dict = getReversedValuesDict(values_dict)
+    codes, size, tokens = getAnswerTokens(dfColumn)
+    codified = tokens.map(reversed_values_dict).fillna(other_value)
+    joined = codified.groupby(level=0, sort=False).agg("|".join)
+    values = np.full(size + 1, other_value, dtype=object)
+    values[joined.index.to_numpy()] = joined.to_numpy()
+    # missing answers have code -1 and take the trailing other_value
+    return Series(values[codes], index=dfColumn.index, name=dfColumn.name)
+
+
+def getBitmaskLayout(values_dict: dict[int, str]):
+    """
+    return bit of the "other" flag and unsigned integer dtype of a bitmask column.
+
+    Every code is stored in the bit of the same number, the bit following the highest code flags
+    answers that could not be codified.
+    """
+    other_bit = max([int(x) for x in values_dict.keys()]) + 1
+    if (other_bit < 32):
+        return other_bit, np.dtype(np.uint32)
+    if (other_bit < 64):
+        return other_bit, np.dtype(np.uint64)
+    raise ValueError(
+        f"codes above 62 cannot be stored in a bitmask, highest code is {other_bit - 1}")
+
+
+def processColumnBitmask(dfColumn: Series, values_dict: dict[int, str]):
+    """
+    return a uint32/uint64 column with the bit of every code present in a multi-select answer set.
+
+    Missing answers and tokens that cannot be codified set the "other" bit (see `getBitmaskLayout`).
+    """
+    other_bit, dtype = getBitmaskLayout(values_dict)
+    reversed_values_dict = dict([(x[1], int(x[0]))
+                                for x in values_dict.items()])
+    codes, size, tokens = getAnswerTokens(dfColumn)
+    bits = tokens.map(reversed_values_dict).fillna(
+        other_bit).to_numpy(dtype=np.uint64)
+    masks = Series(np.left_shift(np.uint64(1), bits).astype(
+        dtype), index=tokens.index)
+    combined = masks.groupby(level=0, sort=False).agg(np.bitwise_or.reduce)
+    values = np.full(size + 1, np.left_shift(1, other_bit), dtype=dtype)
+    values[combined.index.to_numpy(dtype=np.int64)] = combined.to_numpy()
+    return Series(values[codes], index=dfColumn.index, name=dfColumn.name)
+
+
+def decodeBitmaskColumn(dfColumn: Series, values_dict: dict[int, str], other_value: str):
+    """
+    return pipe-joined codes of a bitmask column, in ascending code order with other_value last
+    """
+    other_bit, dtype = getBitmaskLayout(values_dict)
+    bits = sorted([int(x) for x in values_dict.keys()]) + [other_bit]
+    labels = [str(x) for x in bits[:-1]] + [str(other_value)]
+    uniques, codes = np.unique(dfColumn.to_numpy(dtype=dtype),
+                               return_inverse=True)
+    decoded = np.array(["|".join([label for bit, label in zip(bits, labels) if (int(mask) >> bit) & 1])
+                        for mask in uniques], dtype=object)
+    return Series(decoded[codes], index=dfColumn.index, name=dfColumn.name)
+
+
+def bitmaskToIndicators(dfColumn: Series, values_dict: dict[int, str], prefix: str):
+    """
+    return DataFrame of sparse boolean indicator columns `{prefix}_{code}` and `{prefix}_other` from a bitmask column
+    """
+    other_bit, dtype = getBitmaskLayout(values_dict)
+    masks = dfColumn.to_numpy(dtype=dtype)
+    bits = sorted([int(x) for x in values_dict.keys()]) + [other_bit]
+    names = [f"{prefix}_{x}" for x in bits[:-1]] + [f"{prefix}_other"]
+    sparse_dtype = SparseDtype(bool, False)
+    return DataFrame({name: Series(np.bitwise_and(np.right_shift(masks, dtype.type(bit)), dtype.type(1)).astype(bool), index=dfColumn.index, dtype=sparse_dtype)
+                      for name, bit in zip(names, bits)})
+
+
+def indicatorsToBitmask(df: DataFrame, values_dict: dict[int, str], prefix: str):
+    """
+    return bitmask column from the sparse indicator columns produced by `bitmaskToIndicators`
+    """
+    other_bit, dtype = getBitmaskLayout(values_dict)
+    bits = sorted([int(x) for x in values_dict.keys()]) + [other_bit]
+    names = [f"{prefix}_{x}" for x in bits[:-1]] + [f"{prefix}_other"]
+    output = np.zeros(len(df), dtype=dtype)
+    for name, bit in zip(names, bits):
+        output |= np.left_shift(df[name].to_numpy(
+            dtype=bool).astype(dtype), dtype.type(bit))
+    return Series(output, index=df.index, name=prefix)
+
+
+multi_value_modes = ["codes", "bitmask", "sparse"]
+
+
+def processMultValueColumns(df: DataFrame, columnObjectsList: dict[dict], mode: str = "codes"):
     """
     df: DataFrame object
     columnsObjectsList: dictionary of column object
     columnObject: dictionary {"target_column": str, "output_column": str, values_dict: dict, other_value: str}
+    mode: (optional) "codes" for pipe-joined codes, "bitmask" for an unsigned integer bitmask column,
+    "sparse" for a bitmask column plus sparse boolean indicator columns `{output_column}_{code}`
 
     return DataFrame Object
     """
+    if (mode not in multi_value_modes):
+        raise ValueError(
+            f"mode must be one of {multi_value_modes}, got {mode}")
     for columnObject in columnObjectsList:
         try:
             current = columnObjectsList[columnObject]
@@ -122,8 +238,16 @@ def processMultValueColumns(df: DataFrame, columnObjectsList: dict[dict]):
             output_column = current["output_column"]
             values_dict = current["values_dict"]
             other_value = str(current["other_value"])
-            df[output_column] = processColumn(
-                df[target_column], values_dict, other_value)
+            if (mode == "codes"):
+                df[output_column] = processColumn(
+                    df[target_column], values_dict, other_value)
+                continue
+            df[output_column] = processColumnBitmask(
+                df[target_column], values_dict)
+            if (mode == "sparse"):
+                indicators = bitmaskToIndicators(
+                    df[output_column], values_dict, output_column)
+                df[indicators.columns] = indicators
         except Exception as e:
             print(e)
             continue
@@ -166,25 +290,79 @@ def valueLabelChange(value: str, values_dict: dict[str, str], otherValue: str):
         return value
 
 
-def processValueReplacement(df: DataFrame, replace_dict: dict[str, dict[str, str]]):
+def mapUniqueValues(dfColumn: Series, func):
+    """
+    return column with `func` applied once per unique value, missing values included
+    """
+    codes, uniques = dfColumn.factorize(use_na_sentinel=False)
+    values = np.array([func(x) for x in np.asarray(uniques, dtype=object)] + [None],
+                      dtype=object)
+    # numeric results get a numeric dtype, as with Series.apply
+    return Series(values[codes], index=dfColumn.index, name=dfColumn.name).infer_objects()
+
+
+def getCodeLabel(value, labels: dict[str, str]):
+    """
+    return label of a numeric code given as int or text, the value itself when it is not a known code
+    and None when it is missing
+    """
+    try:
+        if (type(value) == int):
+            return labels[str(value)]
+        if (type(value) == str):
+            return labels[str(int(value))]
+    except Exception as e:
+        return value
+    return None
+
+
+def mapCodeLabels(dfColumn: Series, labels: dict[str, str]):
+    """
+    return column of numeric codes replaced with their labels, see `getCodeLabel`
+    """
+    return mapUniqueValues(dfColumn, lambda x: getCodeLabel(x, labels))
+
+
+def mapLabelCodes(dfColumn: Series, codes: dict[str, int]):
     """
-    return DataFrame with some values replaced using a dictonary
+    return column of labels replaced with their codes, values without a code are kept
     """
-    local_df = deepcopy(df)
+    return mapUniqueValues(dfColumn, lambda x: codes.get(x, x))
+
+
+def getEqualLengthMask(df: DataFrame, columns: list[str]):
+    """
+    return boolean mask of rows whose list columns all have the same number of elements, rows with a missing list are excluded
+    """
+    lengths = DataFrame({column: df[column].str.len()
+                        for column in columns}, index=df.index)
+    return lengths.eq(lengths[columns[0]], axis=0).all(axis=1)
+
+
+def processValueReplacement(df: DataFrame, replace_dict: dict[str, dict[str, str]], inplace: bool = False):
+    """
+    return DataFrame with some values replaced using a dictonary.
+
+    Only the replaced columns are new arrays, the other columns are shared with `df`.
+    When `inplace` is True `df` itself is modified and returned.
+    """
+    local_df = df if inplace else df.copy(deep=False)
     columns = list(replace_dict.keys())
 
     for col in columns:
-        local_df[col] = local_df[col].apply(
-            lambda x: valueLabelChange(x, replace_dict[col], "Otro"))
+        local_df[col] = mapUniqueValues(
+            local_df[col], lambda x: valueLabelChange(x, replace_dict[col], "Otro"))
 
     return local_df
 
 
-def capitaliseColumns(df: DataFrame, columns: list[str]):
+def capitaliseColumns(df: DataFrame, columns: list[str], inplace: bool = False):
     """
     return DataFrame with column values that have been capitalised.
+
+    When `inplace` is True `df` itself is modified and returned.
     """
-    local_df = deepcopy(df)
+    local_df = df if inplace else df.copy(deep=False)
     for col in columns:
         try:
             local_df[col] = local_df[col].str.title()
@@ -193,37 +371,131 @@ def capitaliseColumns(df: DataFrame, columns: list[str]):
     return local_df
 
 
-def replaceOrganisation(df: DataFrame, value: str, col1: str, col2: str):
-    local_df = deepcopy(df)
-    output_values = []
-    _col1 = list(local_df[col1].to_list())
-    _col2 = list(local_df[col2].to_list())
-    _merge = zip(_col1, _col2)
-    for (target, replacement) in _merge:
-        if (type(target) == float):
-            output_values.append("Otros")
-        elif (target == value):
-            if (type(replacement) == str):
-                output_values.append(replacement)
-            else:
-                output_values.append("Otros")
-        else:
-            output_values.append(target)
+def replaceOrganisation(df: DataFrame, value: str, col1: str, col2: str, inplace: bool = False):
+    """
+    return DataFrame where `col1` values equal to `value` are replaced with the value of `col2`.
 
-    local_df[col1] = Series(output_values)
+    Missing values, and `value` rows without a `col2` text, become "Otros".
+    When `inplace` is True `df` itself is modified and returned.
+    """
+    local_df = df if inplace else df.copy(deep=False)
+    target = local_df[col1]
+    replacement = local_df[col2]
+    is_value = (target == value).to_numpy()
+    has_replacement = (replacement.map(type) == str).to_numpy()
+    output_values = np.where(is_value & has_replacement, replacement.to_numpy(dtype=object),
+                             target.to_numpy(dtype=object))
+    output_values[target.isna().to_numpy() | (is_value & ~has_replacement)] = "Otros"
+
+    local_df[col1] = output_values
     return local_df
 
 
-def changeCountriesByExpression(country: str, valueDict: dict[str, str]):
+def foldText(value: str):
     """
-    return a country name value after being testing through an expresion
+    return value in lower case, without surrounding spaces and without accents
+    """
+    decomposed = unicodedata.normalize("NFKD", value.strip().lower())
+    return "".join([x for x in decomposed if not unicodedata.combining(x)])
+
+
+def getEditDistance(first: str, second: str, max_distance: int):
+    """
+    return levenshtein distance between two values, or max_distance + 1 as soon as it is known to be larger than max_distance
+    """
+    if (abs(len(first) - len(second)) > max_distance):
+        return max_distance + 1
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, start=1):
+        current = [i]
+        for j, second_char in enumerate(second, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        if (min(current) > max_distance):
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class CountryNormalizer:
+    """
+    Country name normalization engine.
+
+    All expressions of the value dictionary are compiled once into a single alternation, the
+    first expression (in dictionary order) that matches a value followed by one more character
+    gives its replacement. Values are matched accent folded and lower cased so that "Perú", "peru"
+    and "PERU" resolve identically, values that match no expression are returned unchanged, and
+    results are memoized per unique input.
+
+    Parameters
+    ----------
+    valueDict: dictionary of expressions and their replacement country name
     """
-    for key, value in valueDict.items():
-        match = re.match(r"^"+key+r".$", country)
+
+    def __init__(self, valueDict: dict[str, str]):
+        self.replacements = list(valueDict.values())
+        self.group_names = [f"k{index}" for index in range(len(valueDict))]
+        alternation = "|".join(
+            [f"(?P<{name}>{key})" for name, key in zip(self.group_names, valueDict.keys())])
+        self.expression = re.compile(
+            r"^(?:" + alternation + r").$") if alternation else None
+        self._memo = {}
+
+    def normalize(self, country: str):
+        """
+        return normalized country name, or the value itself when no expression matches
+        """
+        try:
+            return self._memo[country]
+        except KeyError:
+            pass
+        output = country
+        # the folded value is only the key matched against the expressions
+        match = self.expression.match(
+            foldText(country)) if self.expression else None
         if (match):
-            return value
+            groups = match.groupdict()
+            for index, name in enumerate(self.group_names):
+                if (groups[name] is not None):
+                    output = self.replacements[index]
+                    break
+        self._memo[country] = output
+        return output
+
+    def normalizeColumn(self, column: Series):
+        """
+        return column with normalized country names, computed once per unique value. Values that are not text are kept as missing values.
+        """
+        categories = column.astype("category")
+        normalized = []
+        for country in categories.cat.categories:
+            try:
+                normalized.append(self.normalize(country))
+            except Exception as e:
+                normalized.append(None)
+        # missing values (code -1) take the trailing None
+        values = np.array(normalized + [None], dtype=object)
+        return Series(values[categories.cat.codes.to_numpy()], index=column.index, name=column.name)
+
+
+_country_normalizers: dict[tuple, CountryNormalizer] = {}
+
+
+def getCountryNormalizer(valueDict: dict[str, str]):
+    """
+    return a compiled country normalizer, reused for the same dictionary
+    """
+    key = tuple(valueDict.items())
+    if (key not in _country_normalizers):
+        _country_normalizers[key] = CountryNormalizer(valueDict)
+    return _country_normalizers[key]
+
 
-    return country
+def changeCountriesByExpression(country: str, valueDict: dict[str, str]):
+    """
+    return a country name value after being testing through an expresion
+    """
+    return getCountryNormalizer(valueDict).normalize(country)
 
 
 def processCountries(countries: list[str], valueDict: dict[str, str]):
@@ -239,14 +511,3 @@ def processCountries(countries: list[str], valueDict: dict[str, str]):
         except Exception as e:
             output.append(default_missing_value)
     return output
-
-
-def toUnixTimestamp(time, format: str = "%d/%m/%Y"):
-    """
-    return number in unixtime after parsing a date string
-    """
-    start = datetime(1970, 1, 1)
-    target = datetime.strptime(time, format)
-    in_seconds = (target - start).total_seconds()
-    in_milliseconds = int(in_seconds) * 1000
-    return in_milliseconds
@@ -1,31 +1,191 @@
 import sys
-from pandas import Series
-from geopandas import GeoSeries, GeoDataFrame
-from pandas import DataFrame, Series, concat
-from geopandas import GeoDataFrame
-from copy import deepcopy
+from pandas import Series, Index, RangeIndex, concat, unique
+from geopandas import GeoSeries, GeoDataFrame, points_from_xy
+from pandas import DataFrame, Series
+import numpy as np
+from functools import lru_cache
 from shapely.geometry import Point
-from .custom_functions import changeCountriesByExpression, getProgressIndicator
+from .custom_functions import changeCountriesByExpression, getCountryNormalizer, getProgressIndicator, foldText, getEditDistance
+from .custom_defaults import loadDefault, loadCompiledDefault
+from .custom_cache import GeocodeCache, GeocodeJournal
+from .custom_geocoder import processGeocodeData, MapboxGeocodingClient, OfflineGeocoder, default_max_workers, default_rate_limit
 
 # Mapbox
 from mapbox import Geocoder
 
 default_missing_value = 999999
 
+# properties added by reverse geocoding, one column per administrative level
+geocode_columns = ["country_text", "country_name", "country_code",
+                   "region_text", "region_name", "place_text", "place_name"]
 
-def getCountriesWithCoordinates(countries: list[str], geo_countries: DataFrame):
+
+class CountryGazetteer:
+    """
+    Indexed gazetteer of country centroids.
+
+    Country names are indexed by their accent folded lower case value, together with an alias table
+    of alternative names, and ISO codes only for the `code_columns` given (columns holding codes, not
+    free text where "no" or "es" are words). Values that are not indexed fall back to a bounded fuzzy
+    match (edit distance over candidates sharing character trigrams) to absorb typos: at most 1 edit
+    for values of 6 characters or less and `max_distance` for longer ones, and ties are rejected.
+    Fuzzy matches are collected in `substitutions` and values that cannot be resolved in `unresolved`.
+
+    Parameters
+    ----------
+    table: DataFrame of countries with a name column, code columns and coordinates
+    aliases: (optional) dictionary of alternative names and the country name they refer to
+    name_column: (optional) column of country names
+    code_columns: (optional) columns of country codes
+    max_distance: (optional) maximum edit distance accepted by the fuzzy match for values longer than 6 characters
+    """
+
+    def __init__(self, table: DataFrame, aliases: dict[str, str] = {}, name_column: str = "name", code_columns: list[str] = [], max_distance: int = 2):
+        self.table = table.reset_index(drop=True)
+        self.name_column = name_column
+        self.max_distance = max_distance
+        self.index: dict[str, int] = {}
+        for column in code_columns:
+            for position, code in enumerate(self.table[column]):
+                # natural earth uses -99 for missing codes
+                if (type(code) == str and code != "-99"):
+                    self.index[foldText(code)] = position
+        for position, name in enumerate(self.table[name_column]):
+            self.index[foldText(name)] = position
+        for alias, name in aliases.items():
+            position = self.index.get(foldText(name))
+            if (position is not None):
+                self.index.setdefault(foldText(alias), position)
+
+        self.ngrams: dict[str, set[str]] = {}
+        for key in self.index:
+            if (len(key) > 3):
+                for ngram in self._getNgrams(key):
+                    self.ngrams.setdefault(ngram, set()).add(key)
+
+        self.unresolved: set[str] = set()
+        self.substitutions: dict[str, str] = {}
+        self._memo: dict[str, int] = {}
+
+    @staticmethod
+    def _getNgrams(value: str):
+        padded = f" {value} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def getMaxDistance(self, key: str):
+        """
+        return maximum edit distance accepted by the fuzzy match of a value, scaled with its length
+        """
+        if (len(key) <= 3):
+            return 0
+        if (len(key) <= 6):
+            return min(1, self.max_distance)
+        return self.max_distance
+
+    def _fuzzyMatch(self, key: str):
+        """
+        return position of the single closest indexed value within the maximum distance, or -1 when there is none or a tie
+        """
+        max_distance = self.getMaxDistance(key)
+        if (max_distance == 0):
+            return -1
+        shared: dict[str, int] = {}
+        for ngram in self._getNgrams(key):
+            for candidate in self.ngrams.get(ngram, []):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        best_positions, best_distance = set(), max_distance + 1
+        for candidate in sorted(shared, key=lambda x: (-shared[x], x))[:20]:
+            distance = getEditDistance(key, candidate, max_distance)
+            if (distance < best_distance):
+                best_positions, best_distance = {
+                    self.index[candidate]}, distance
+            elif (distance == best_distance and distance <= max_distance):
+                best_positions.add(self.index[candidate])
+        return best_positions.pop() if len(best_positions) == 1 else -1
+
+    def resolve(self, value: str):
+        """
+        return row position of a country in the table, or -1 when it cannot be resolved
+        """
+        if (type(value) != str):
+            return -1
+        if (value in self._memo):
+            return self._memo[value]
+        key = foldText(value)
+        position = self.index.get(key)
+        if (position is None):
+            position = self._fuzzyMatch(key)
+            if (position < 0):
+                self.unresolved.add(value)
+            else:
+                self.substitutions[value] = self.table[self.name_column].iat[position]
+        self._memo[value] = position
+        return position
+
+    def resolveColumn(self, column: Series):
+        """
+        return array of row positions of the countries of a column, resolved once per unique value. -1 when it cannot be resolved.
+        """
+        categories = column.astype("category")
+        positions = np.array([self.resolve(value) for value in categories.cat.categories] + [-1],
+                             dtype=np.int64)
+        return positions[categories.cat.codes.to_numpy()]
+
+    def reportUnresolved(self):
+        if (len(self.unresolved) > 0):
+            print(
+                f"{len(self.unresolved)} countries not associated with coordinates: {sorted(self.unresolved)}")
+
+    def reportSubstitutions(self):
+        if (len(self.substitutions) > 0):
+            print(f"{len(self.substitutions)} countries associated by approximate match: " +
+                  ", ".join([f"{value} -> {name}" for value, name in sorted(self.substitutions.items())]))
+
+    def report(self):
+        """
+        print the values resolved by approximate match and the values that could not be resolved
+        """
+        self.reportSubstitutions()
+        self.reportUnresolved()
+
+
+@lru_cache
+def getCountryAliases():
+    """
+    return dictionary of alternative country names in `defaults/country_aliases.json`, loaded once
+    """
+    return loadDefault("country_aliases.json")
+
+
+@lru_cache
+def getCountryGazetteer():
+    """
+    return the gazetteer of `defaults/countries.json`, loaded once
+    """
+    return CountryGazetteer(loadCompiledDefault("countries.json"), getCountryAliases())
+
+
+def getCountriesWithCoordinates(countries: list[str], geo_countries: DataFrame = None):
+    """
+    return dictionary of coordinates of each country, 999999 when it cannot be resolved.
+
+    Parameters
+    ----------
+    countries: list of country names
+    geo_countries: (optional) DataFrame of countries with name, x and y columns, defaults to the gazetteer of `defaults/countries.json`
+    """
+    gazetteer = getCountryGazetteer() if geo_countries is None else CountryGazetteer(
+        geo_countries, aliases=getCountryAliases())
     output = {}
     for country in countries:
-        try:
-            filtered_country = geo_countries[geo_countries["name"].str.lower(
-            ) == country].reindex()
-            centroidValue = filtered_country.iloc[0]
-            output[country] = {"x": centroidValue.x, "y": centroidValue.y}
-        except Exception as e:
-            print(e, "not associated with", country)
+        position = gazetteer.resolve(country)
+        if (position < 0):
             output[country] = {"x": default_missing_value,
                                "y": default_missing_value}
-
+        else:
+            centroidValue = gazetteer.table.iloc[position]
+            output[country] = {"x": centroidValue.x, "y": centroidValue.y}
+    gazetteer.report()
     return output
 
 
@@ -40,39 +200,59 @@ def getCoordinate(value: str, side: str, valueDict: dict[str, tuple[int, int]],
         return default_missing_value
 
 
-def processFieldCoordinates(df: DataFrame, columnDict: dict[str, dict[str, str]], valueDict: dict[str, tuple[int, int]], expressionDict: dict[str, str]):
+def processFieldCoordinates(df: DataFrame, columnDict: dict[str, dict[str, str]], valueDict: dict[str, tuple[int, int]] = None, expressionDict: dict[str, str] = {}, inplace: bool = False):
     """
     return a dataframe with coordinates fields retrieved from a coordinates dictionary.
+
+    The values of every country column are normalized and looked up together, once per unique
+    value, and each coordinate field is then written with a single indexing operation. The input
+    DataFrame is not copied, only the coordinate fields are new columns.
+
+    Parameters
+    ----------
+    df: DataFrame object
+    columnDict: dictionary of country columns and their {"x": column, "y": column} coordinate fields
+    valueDict: (optional) dictionary of normalized countries and their coordinates, defaults to looking countries up in the gazetteer
+    expressionDict: (optional) dictionary of country name expressions used to normalize values
+    inplace: (optional) add the coordinate fields to `df` itself
     """
-    local_df = deepcopy(df)
-    for column in columnDict.keys():
-        local_df[columnDict[column]["x"]] = local_df[column].str.lower().apply(
-            lambda x: getCoordinate(x, "x", valueDict, expressionDict))
-        local_df[columnDict[column]["y"]] = local_df[column].str.lower().apply(
-            lambda x: getCoordinate(x, "y", valueDict, expressionDict))
+    local_df = df if inplace else df.copy(deep=False)
+    columns = list(columnDict.keys())
+    normalizer = getCountryNormalizer(expressionDict)
+    gazetteer = getCountryGazetteer() if valueDict is None else None
 
-    return local_df
+    uniques = Index(unique(concat([df[column] for column in columns],
+                                  ignore_index=True).dropna()))
+    x_values = np.full(len(uniques) + 1, default_missing_value, dtype=float)
+    y_values = np.full(len(uniques) + 1, default_missing_value, dtype=float)
+    for position, value in enumerate(uniques):
+        if (type(value) != str):
+            continue
+        country = normalizer.normalize(value.lower())
+        if (gazetteer is not None):
+            row = gazetteer.resolve(country)
+            if (row >= 0):
+                x_values[position] = gazetteer.table["x"].iat[row]
+                y_values[position] = gazetteer.table["y"].iat[row]
+        elif (country in valueDict):
+            x_values[position] = valueDict[country]["x"]
+            y_values[position] = valueDict[country]["y"]
+    if (gazetteer is not None):
+        gazetteer.report()
 
+    for column in columns:
+        # missing values get -1 and take the trailing default
+        codes = uniques.get_indexer(df[column])
+        local_df[columnDict[column]["x"]] = x_values[codes]
+        local_df[columnDict[column]["y"]] = y_values[codes]
 
-def processGeocodeData(data):
-    """
-    return extracted properties from results of reverse geocoding
-    """
-    features = data['features']
-    output = {}
-    for feature in features:
-        _id: str = feature['id']
-        id = _id.split(".")[0]
-        output[f"{id}_text"] = feature["text"]
-        output[f"{id}_name"] = feature["place_name"]
-        if (id == "country"):
-            output["country_code"] = feature["properties"]["short_code"]
-    return output
+    return local_df
 
 
+@lru_cache
 def getMapboxGeocoder(token: str):
     """
-    return a mapbox geocoder object
+    return a mapbox geocoder object, reused for the same token
     """
     if (token):
         return Geocoder(access_token=token)
@@ -93,52 +273,146 @@ def reverseGeocode(longitude: int, latitude: int, token: str):
         return None
 
 
-def processReverseGeoding(data: list[tuple[int, int, int]], token: str, name: str):
+def processReverseGeoding(data: list[tuple[int, int, int]], token: str, name: str, cache: GeocodeCache = None, max_workers: int = default_max_workers, rate_limit: int = default_rate_limit, geocoder: OfflineGeocoder = None, client: MapboxGeocodingClient = None, journal: GeocodeJournal = None):
     """
-    return list of objects with geo-administrative properties
+    return list of objects with geo-administrative properties in the same order as the input data
+
+    Parameters
+    ----------
+    data: list of (id, longitude, latitude) tuples
+    token: mapbox access token
+    name: name shown in the progress indicator
+    cache: (optional) persistent cache consulted before requesting mapbox
+    max_workers: (optional) number of concurrent requests to mapbox
+    rate_limit: (optional) maximum requests per minute to mapbox
+    geocoder: (optional) offline geocoder, mapbox is only requested for coordinates it cannot resolve and when a token is given
+    client: (optional) long-lived mapbox client, used instead of creating one from token, cache, max_workers and rate_limit
+    journal: (optional) journal of a previous run, coordinates already journaled are skipped and new mapbox results are appended as they arrive
     """
-    _output = []
-    pbar = getProgressIndicator(
-        data=data, desc=f"Processing Reverse Geocoding {name}", size=7, unit="coords")
-    for id, lon, lat in data:
-        try:
-            result = reverseGeocode(lon, lat, token)
-            _decoded = processGeocodeData(result)
-            _decoded['id'] = id
-            _output.append(_decoded)
-            pbar.update(1)
-            # sleep(0.1)
+    _client = client if client is not None else MapboxGeocodingClient(
+        token, cache=cache, max_workers=max_workers, rate_limit=rate_limit)
+    _output = [None] * len(data)
+    pending = []
+    for index, (id, lon, lat) in enumerate(data):
+        _cached = journal.get(lon, lat) if journal else None
+        if (_cached is None):
+            _cached = _client.getCached(lon, lat)
+        if (_cached is None):
+            pending.append(index)
+        else:
+            _output[index] = _cached
+
+    if (_client.cache is not None):
+        print(
+            f"{len(data) - len(pending)} of {len(data)} coordinates retrieved from cache")
+
+    if (geocoder is not None):
+        resolved = geocoder.reverseGeocodeMany(
+            [(data[index][1], data[index][2]) for index in pending])
+        unresolved = []
+        for index, _decoded in zip(pending, resolved):
+            if (_decoded is None):
+                unresolved.append(index)
+            else:
+                _output[index] = _decoded
+        print(
+            f"{len(pending) - len(unresolved)} of {len(pending)} coordinates resolved offline")
+        pending = unresolved
+        if (_client.geocoder is None):
+            pending = []
+
+    if (len(pending) > 0 and _client.geocoder is None):
+        print("Invalid Token")
+        pending = []
 
-        except Exception as e:
-            print(e)
-            _output.append({"id": id})
+    if (len(pending) > 0):
+        pbar = getProgressIndicator(
+            data=pending, desc=f"Processing Reverse Geocoding {name}", size=7, unit="coords")
+        def journalResult(position: int, _decoded: dict):
+            if (journal is not None and _decoded is not None):
+                _, lon, lat = data[pending[position]]
+                journal.append(lon, lat, _decoded)
 
-    return _output
+        results = _client.reverseGeocodeMany(
+            [(data[index][1], data[index][2]) for index in pending], use_cache=False, pbar=pbar, callback=journalResult)
+        pbar.close()
+        for index, _decoded in zip(pending, results):
+            _output[index] = _decoded
+        print(_client.getMetrics())
 
+    if (client is None):
+        _client.close()
 
-def addReverseGeocodedToDataFrame(df: DataFrame, lon_column: str, lat_column: str, token: str, name: str, id="objectid"):
+    return [dict(_decoded or {}, id=data[index][0]) for index, _decoded in enumerate(_output)]
+
+
+def addReverseGeocodedToDataFrame(df: DataFrame, lon_column: str, lat_column: str, token: str, name: str, id="objectid", cache: GeocodeCache = None, max_workers: int = default_max_workers, rate_limit: int = default_rate_limit, geocoder: OfflineGeocoder = None, precision: int = None, client: MapboxGeocodingClient = None, journal: GeocodeJournal = None, inplace: bool = False):
     """
     return dataframe with geo-administrative attributes fields as related longitude and latitude of each row.
 
+    Rows are collapsed to unique coordinate cells before geocoding and the results are attached
+    back to every row of the cell by position, so `id` does not need to be unique and the number
+    of rows is preserved. All `geocode_columns` are always added. When `precision` is given,
+    coordinates are snapped to that number of decimals first so that nearby interactions share
+    a cell (4 decimals is roughly 11 meters).
+
+    Results found in `cache` are reused instead of requesting mapbox again. When an offline `geocoder`
+    is given it resolves the remaining coordinates first. Whatever is left is requested to mapbox
+    concurrently with `max_workers` requests at most `rate_limit` per minute, or through `client`
+    when a long-lived mapbox client is given. Results are appended to `journal` as they arrive and
+    coordinate cells already present in it are not geocoded again.
+
+    The returned DataFrame shares the input columns and has a new range index. When `inplace` is
+    True the columns are added to `df` itself and its index is kept.
     """
-    local_df = deepcopy(df)
-    coordinates = list(zip(list(local_df[id].to_list()), list(local_df[lon_column].astype(float).to_list()), list(
-        local_df[lat_column].astype(float).to_list())))
-    reversed_geocoded = processReverseGeoding(coordinates, token, name)
-    reversed_geocoded_df = DataFrame(reversed_geocoded)
-    output = concat([local_df.set_index(id), reversed_geocoded_df.set_index("id")],
-                    axis=1).reset_index(names=[id])
-    return output
+    if (inplace):
+        local_df = df
+    else:
+        local_df = df.copy(deep=False)
+        local_df.index = RangeIndex(len(local_df))
+    cells = DataFrame({
+        "lon": local_df[lon_column].astype(float).to_numpy(),
+        "lat": local_df[lat_column].astype(float).to_numpy(),
+    })
+    if (precision is not None):
+        cells = cells.round(precision)
+
+    # position of each row's cell among the unique cells, in order of first appearance
+    codes = cells.groupby(["lon", "lat"], sort=False,
+                          dropna=False).ngroup().to_numpy()
+    unique_cells = cells.drop_duplicates(ignore_index=True)
+    if (len(cells) > 0):
+        print(
+            f"{len(unique_cells)} unique coordinate cells for {len(cells)} rows ({len(cells) / max(len(unique_cells), 1):.1f}x deduplication)")
+
+    coordinates = list(zip(unique_cells.index.to_list(), unique_cells["lon"].to_list(),
+                           unique_cells["lat"].to_list()))
+    reversed_geocoded = processReverseGeoding(
+        coordinates, token, name, cache=cache, max_workers=max_workers, rate_limit=rate_limit, geocoder=geocoder, client=client, journal=journal)
+
+    for column in geocode_columns:
+        # trailing None is taken by rows whose cell could not be determined (code -1)
+        values = np.array([_decoded.get(column) for _decoded in reversed_geocoded] + [None],
+                          dtype=object)
+        local_df[column] = values[codes]
+
+    if (len(local_df) != len(df)):
+        raise Exception("Reverse geocoding changed the number of rows")
+    return local_df
 
 
 def dataFrameToGeoDataFrame(df: DataFrame, geometry_column_name: str, lat_column: str, long_column: str):
     """
-    Returns GeoDataFrame from DataFrame with location fields
+    Returns GeoDataFrame from DataFrame with location fields.
+
+    The point geometry column is built from longitude and latitude in one vectorized call,
+    the other columns are shared with `df`.
     """
-    local_df = deepcopy(df)
-    local_df[geometry_column_name] = Point(
-        local_df[lat_column], local_df[long_column])
-    local_geo_df = GeoDataFrame(local_df)
+    local_df = df.copy(deep=False)
+    local_df[geometry_column_name] = points_from_xy(
+        local_df[long_column], local_df[lat_column])
+    local_geo_df = GeoDataFrame(
+        local_df, geometry=geometry_column_name, crs="EPSG:4326")
     return local_geo_df
 
 
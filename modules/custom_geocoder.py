@@ -0,0 +1,342 @@
+import os
+import random
+import threading
+from time import monotonic, sleep
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+import numpy as np
+import shapely
+from shapely import STRtree
+from geopandas import read_file
+from .custom_cache import GeocodeCache
+
+# Mapbox
+from mapbox import Geocoder
+
+# Mapbox geocoding api default limit is 600 requests per minute
+default_rate_limit = 600
+default_max_workers = 8
+default_retries = 5
+default_backoff = 0.5
+default_timeout = 10
+
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# feature types consumed by processGeocodeData
+default_types = ["country", "region", "place"]
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to keep requests under a rate limit.
+
+    Parameters
+    ----------
+    rate: number of tokens refilled per period
+    period: (optional) period length in seconds
+    capacity: (optional) maximum number of tokens that can be accumulated, defaults to a tenth of the rate
+    """
+
+    def __init__(self, rate: int, period: float = 60, capacity: int = 0):
+        self.rate = rate
+        self.period = period
+        self.capacity = capacity or max(1, rate // 10)
+        self._tokens = float(self.capacity)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        block until a token is available and take it
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens +
+                                   (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if (self._tokens >= 1):
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.period / self.rate
+            sleep(wait)
+
+
+def setSessionTimeout(geocoder: Geocoder, timeout: float):
+    """
+    return geocoder whose http session uses a default timeout for every request
+    """
+    geocoder.session.request = partial(
+        geocoder.session.request, timeout=timeout)
+    return geocoder
+
+
+def getRetryDelay(response, attempt: int, backoff: float):
+    """
+    return seconds to wait before retrying a request
+    """
+    retry_after = response.headers.get(
+        "Retry-After") if response is not None else None
+    if (retry_after):
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return backoff * (2 ** attempt) + random.uniform(0, backoff)
+
+
+def reverseGeocodeWithRetry(geocoder: Geocoder, longitude: float, latitude: float, limiter: TokenBucket = None, retries: int = default_retries, backoff: float = default_backoff, types: list[str] = None):
+    """
+    return reverse geocoded data from coordinates, retrying with exponential backoff on rate limiting, server errors and timeouts.
+    """
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            if (limiter):
+                limiter.acquire()
+            response = geocoder.reverse(
+                lon=longitude, lat=latitude, types=types)
+            if (response.status_code == 200):
+                return response.json()
+            if (response.status_code not in retry_status_codes):
+                return None
+        except (ConnectionError, Timeout) as e:
+            if (attempt == retries):
+                raise e
+        if (attempt < retries):
+            sleep(getRetryDelay(response, attempt, backoff))
+    return None
+
+
+def processGeocodeData(data):
+    """
+    return extracted properties from results of reverse geocoding
+    """
+    features = data['features']
+    output = {}
+    for feature in features:
+        _id: str = feature['id']
+        id = _id.split(".")[0]
+        output[f"{id}_text"] = feature["text"]
+        output[f"{id}_name"] = feature["place_name"]
+        if (id == "country"):
+            output["country_code"] = feature["properties"]["short_code"]
+    return output
+
+
+class MapboxGeocodingClient:
+    """
+    Long-lived mapbox reverse geocoding client.
+
+    A single keep-alive http session is shared by every request, only the feature `types`
+    consumed by `processGeocodeData` are requested and counters are kept for requests,
+    cache hits, failures and latency.
+
+    Parameters
+    ----------
+    token: mapbox access token
+    types: (optional) mapbox feature types to request
+    cache: (optional) persistent cache consulted before requesting mapbox
+    max_workers: (optional) number of concurrent requests, also the size of the connection pool
+    rate_limit: (optional) maximum requests per minute
+    retries: (optional) retries per request on rate limiting, server errors and timeouts
+    timeout: (optional) seconds before a request is cancelled
+    """
+
+    def __init__(self, token: str, types: list[str] = default_types, cache: GeocodeCache = None, max_workers: int = default_max_workers, rate_limit: int = default_rate_limit, retries: int = default_retries, timeout: float = default_timeout):
+        self.token = token
+        self.types = types
+        self.cache = cache
+        self.max_workers = max_workers
+        self.retries = retries
+        self.limiter = TokenBucket(rate=rate_limit) if rate_limit else None
+        self.geocoder = None
+        if (token):
+            self.geocoder = setSessionTimeout(
+                Geocoder(access_token=token), timeout)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=max_workers)
+            self.geocoder.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.latencies = []
+
+    def getCached(self, longitude: float, latitude: float):
+        """
+        return cached properties for coordinates, or None when they are not cached
+        """
+        if (self.cache is None):
+            return None
+        _decoded = self.cache.get(longitude, latitude)
+        if (_decoded is not None):
+            with self._lock:
+                self.cache_hits += 1
+        return _decoded
+
+    def reverseGeocode(self, longitude: float, latitude: float, use_cache: bool = True):
+        """
+        return geo-administrative properties for coordinates, or None when the request failed
+        """
+        if (use_cache):
+            _cached = self.getCached(longitude, latitude)
+            if (_cached is not None):
+                return _cached
+        if (self.geocoder is None):
+            raise Exception("Invalid Token")
+
+        start = monotonic()
+        try:
+            data = reverseGeocodeWithRetry(
+                self.geocoder, longitude, latitude, self.limiter, self.retries, types=self.types)
+            _decoded = processGeocodeData(data) if data is not None else None
+        except Exception as e:
+            print(e)
+            _decoded = None
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(monotonic() - start)
+            if (_decoded is None):
+                self.failures += 1
+
+        if (_decoded is not None and self.cache is not None):
+            self.cache.set(longitude, latitude, _decoded)
+        return _decoded
+
+    def reverseGeocodeMany(self, coordinates: list[tuple[float, float]], use_cache: bool = True, pbar=None, callback=None):
+        """
+        return list of geo-administrative properties in the same order as the input coordinates.
+
+        Failed requests are returned as None. `callback(index, result)` is called as soon as each result arrives.
+        """
+        output = [None] * len(coordinates)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.reverseGeocode, lon, lat, use_cache): index
+                       for index, (lon, lat) in enumerate(coordinates)}
+            for future in as_completed(futures):
+                index = futures[future]
+                output[index] = future.result()
+                if (callback is not None):
+                    callback(index, output[index])
+                if (pbar is not None):
+                    pbar.update(1)
+        return output
+
+    def getMetrics(self):
+        """
+        return counters of requests, cache hits, failures and p50/p95/p99 latency in milliseconds
+        """
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            metrics = {
+                "requests": self.requests,
+                "cache_hits": self.cache_hits,
+                "failures": self.failures,
+            }
+        for percentile in [50, 95, 99]:
+            metrics[f"p{percentile}_ms"] = round(float(np.percentile(
+                latencies, percentile)), 1) if len(latencies) > 0 else None
+        return metrics
+
+    def close(self):
+        if (self.geocoder is not None):
+            self.geocoder.session.close()
+
+
+class OfflineGeocoder:
+    """
+    Reverse geocoder backed by local admin-boundary polygons (e.g. Natural Earth shapefiles or GeoPackages).
+
+    Points are resolved with a single vectorized STRtree point-in-polygon query and
+    produce the same `country_*` and `region_*` properties as `processGeocodeData`.
+    Regions are only matched within the country of the point, by their parent ISO code,
+    so that a point near a border never gets the region of a neighbouring country.
+
+    Parameters
+    ----------
+    admin0_path: file location of country polygons
+    admin1_path: (optional) file location of first level administrative division polygons
+    admin0_name_column: (optional) country name column of admin0 file
+    admin0_code_column: (optional) ISO 3166-1 alpha-2 code column of admin0 file
+    admin1_name_column: (optional) region name column of admin1 file
+    admin1_code_column: (optional) ISO 3166-1 alpha-2 code column of the country of each region in admin1 file
+    """
+
+    def __init__(self, admin0_path: str, admin1_path: str = "", admin0_name_column: str = "ADMIN", admin0_code_column: str = "ISO_A2_EH", admin1_name_column: str = "name", admin1_code_column: str = "iso_a2"):
+        admin0 = read_file(admin0_path).to_crs(epsg=4326)
+        self.admin0_names = admin0[admin0_name_column].to_numpy(dtype=object)
+        self.admin0_codes = admin0[admin0_code_column].astype(
+            str).str.lower().to_numpy(dtype=object)
+        self.admin0_tree = STRtree(admin0.geometry.to_numpy())
+
+        self.admin1_names = None
+        self.admin1_codes = None
+        self.admin1_tree = None
+        if (admin1_path):
+            admin1 = read_file(admin1_path).to_crs(epsg=4326)
+            self.admin1_names = admin1[admin1_name_column].to_numpy(
+                dtype=object)
+            self.admin1_codes = admin1[admin1_code_column].astype(
+                str).str.lower().to_numpy(dtype=object)
+            self.admin1_tree = STRtree(admin1.geometry.to_numpy())
+
+    @staticmethod
+    def _queryFirst(tree: STRtree, points, size: int, accept=None):
+        """
+        return index of the first polygon containing each point, -1 where there is none.
+        `accept` returns which (point, polygon) index pairs can be kept.
+        """
+        output = np.full(size, -1, dtype=np.int64)
+        input_index, tree_index = tree.query(points, predicate="intersects")
+        if (accept is not None):
+            keep = accept(input_index, tree_index)
+            input_index, tree_index = input_index[keep], tree_index[keep]
+        # reversed so that the first matching polygon is the one kept
+        output[input_index[::-1]] = tree_index[::-1]
+        return output
+
+    def reverseGeocodeMany(self, coordinates: list[tuple[float, float]]):
+        """
+        return list of geo-administrative properties in the same order as the input coordinates.
+
+        Coordinates that are not inside any country are returned as None.
+        """
+        size = len(coordinates)
+        if (size == 0):
+            return []
+        lons, lats = zip(*coordinates)
+        points = shapely.points(lons, lats)
+        countries = self._queryFirst(self.admin0_tree, points, size)
+        regions = self._queryFirst(self.admin1_tree, points, size, accept=lambda input_index, tree_index: (countries[input_index] >= 0) & (
+            self.admin1_codes[tree_index] == self.admin0_codes[countries[input_index]])) if self.admin1_tree is not None else np.full(size, -1)
+
+        output = []
+        for country, region in zip(countries, regions):
+            if (country < 0):
+                output.append(None)
+                continue
+            country_name = self.admin0_names[country]
+            _decoded = {
+                "country_text": country_name,
+                "country_name": country_name,
+                "country_code": self.admin0_codes[country],
+            }
+            if (region >= 0):
+                region_name = self.admin1_names[region]
+                _decoded["region_text"] = region_name
+                _decoded["region_name"] = f"{region_name}, {country_name}"
+            output.append(_decoded)
+        return output
+
+
+def getOfflineGeocoder():
+    """
+    return an offline geocoder using the boundary files in `GEOCODE_ADMIN0_PATH` and `GEOCODE_ADMIN1_PATH`, or None when they are not set.
+    """
+    admin0_path = os.environ.get("GEOCODE_ADMIN0_PATH")
+    if (not admin0_path):
+        return None
+    return OfflineGeocoder(admin0_path=admin0_path, admin1_path=os.environ.get("GEOCODE_ADMIN1_PATH", ""))
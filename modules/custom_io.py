@@ -1,48 +1,417 @@
+import os
+import io
+import copy
 import json
-from pandas import DataFrame
+import uuid
+import random
+import threading
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import shapely
+from pandas import DataFrame, SparseDtype, DatetimeTZDtype
+from geopandas import GeoDataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import feather
+from openpyxl import Workbook
 import carto_auth
 from carto_auth import CartoAuth
-from google.cloud.bigquery import Client
+from google.cloud.bigquery import Client, SourceFormat, CopyJobConfig
+from google.api_core.exceptions import Conflict, ServerError, TooManyRequests
+import requests
+from .custom_functions import loadLocalJsonDoc
+from .custom_cache import UploadManifest, getRowHashes
 
 
-def loadLocalJsonDoc(filepath, dataProp=''):
+export_formats = ["csv", "json", "ndjson", "parquet", "arrow",
+                  "geojson", "geoparquet", "xlsx"]
+
+# parquet codecs: "zstd", "snappy", "gzip" or "none"; arrow (feather) codecs: "zstd", "lz4" or "uncompressed"
+default_compression = "zstd"
+
+# compressions of csv and ndjson files and their file extension
+text_compressions = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+compressions = list(text_compressions.keys())
+
+# compressions a format cannot be written with
+unsupported_compressions = {"arrow": ["gzip"]}
+
+# rows serialised at a time by the streaming writers
+default_batch_size = 10000
+
+# formats serialised in python, written on a process pool by OutputWriter
+process_formats = ["json", "geojson", "xlsx"]
+default_output_workers = 4
+
+# "geoparquet" uploads point geometries as a GeoParquet file, "dataframe" lets the bigquery client serialise the GeoDataFrame
+upload_formats = ["geoparquet", "dataframe"]
+
+# rows of each parquet file loaded into Carto and number of concurrent load jobs
+default_upload_chunk_rows = 100000
+default_upload_workers = 4
+default_upload_retries = 3
+default_upload_backoff = 1.0
+
+# errors of requests that may not have reached the server, or whose response was lost, retried with the same job id
+transient_errors = (ServerError, TooManyRequests, ConnectionError,
+                    requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def getArrowTable(df: DataFrame, schema: pa.Schema = None):
+    """
+    return arrow table of a DataFrame, keeping numeric, datetime and nullable integer dtypes.
+
+    Object columns mixing types (e.g. labels filled with a numeric missing value) are written as text
+    and sparse columns are made dense. Batches of a larger DataFrame are converted with the `schema` of
+    the whole DataFrame (see `getArrowSchema`), so that every batch has the same column types.
+    """
+    local_df = df.copy(deep=False)
+    for column in local_df.columns:
+        values = local_df[column]
+        if (isinstance(values.dtype, SparseDtype)):
+            local_df[column] = values.sparse.to_dense()
+        elif (values.dtype == object):
+            if (schema is not None):
+                as_text = pa.types.is_string(schema.field(str(column)).type)
+            else:
+                try:
+                    pa.array(values, from_pandas=True)
+                    as_text = False
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    as_text = True
+            if (as_text):
+                local_df[column] = values.astype(str).where(values.notna(), None)
+    return pa.Table.from_pandas(local_df, schema=schema, preserve_index=False)
+
+
+def getArrowSchema(df: DataFrame):
+    """
+    return arrow schema of a whole DataFrame, used to convert its batches with `getArrowTable`.
+
+    The type of object columns is inferred from all their values, so that a column holding only numbers
+    in its first rows and text further down is written as text in every batch.
+    """
+    schema = getArrowTable(df.iloc[:0]).schema
+    for position, column in enumerate(df.columns):
+        values = df[column]
+        if (values.dtype == object):
+            try:
+                type = pa.array(values, from_pandas=True).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                type = pa.string()
+            schema = schema.set(position, pa.field(str(column), type))
+    return schema
+
+
+def iterFrameBatches(df: DataFrame, batch_size: int = default_batch_size):
+    """
+    yield consecutive slices of at most `batch_size` rows of a DataFrame, the slices share the data of `df`
+    """
+    for start in range(0, len(df), batch_size):
+        yield df.iloc[start:start + batch_size]
+
+
+def getBatchGeometry(batch: DataFrame, geometry_column: str = "geometry", lat_column: str = "latitude", long_column: str = "longitude"):
     """
-    return deserialised json in dictionary
+    return array of shapely geometries of a batch, from its geometry column or from its longitude and latitude columns
+    """
+    if (geometry_column in batch.columns):
+        return np.asarray(batch[geometry_column], dtype=object)
+    if (lat_column in batch.columns and long_column in batch.columns):
+        return shapely.points(batch[long_column].to_numpy(dtype=float), batch[lat_column].to_numpy(dtype=float))
+    raise ValueError(
+        f"a {geometry_column} column or {long_column} and {lat_column} columns are required to write geometries")
+
+
+def writeGeoJson(batches, filepath: str, geometry_column: str = "geometry", lat_column: str = "latitude", long_column: str = "longitude"):
+    """
+    write batches of rows as a GeoJSON FeatureCollection, one feature at a time.
+
+    Only one batch is serialised at a time, so memory does not grow with the size of the output.
+    Missing values are written as null and the index of each row as the feature `id`, like `GeoDataFrame.to_json`.
 
     Parameters
     ----------
-    filepath: file location or buffer.
-    dataProp: (optional) specified property to access required data
-    """
-    output = {}
-    with open(file=filepath, mode='r', encoding='utf-8') as f:
-        json_load = json.load(f)
-        if (dataProp):
-            output = json_load[dataProp]
-        else:
-            output = json_load
-    return output
+    batches: iterable of DataFrames or GeoDataFrames, e.g. from `iterFrameBatches`
+    filepath: file location
+    geometry_column: (optional) column of shapely geometries, points are built from `long_column` and `lat_column` if it is missing
+    """
+    with open(file=filepath, mode='w', encoding='utf-8') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        separator = ""
+        for batch in batches:
+            geometries = shapely.to_geojson(getBatchGeometry(
+                batch, geometry_column, lat_column, long_column))
+            properties = batch.drop(columns=[geometry_column], errors="ignore")
+            properties = properties.astype(object).where(
+                properties.notna(), None).to_dict(orient="records")
+            for id, record, geometry in zip(batch.index, properties, geometries):
+                f.write(
+                    f'{separator}{{"id": {json.dumps(str(id))}, "type": "Feature", "properties": {json.dumps(record, default=str)}, "geometry": {geometry or "null"}}}')
+                separator = ", "
+        f.write("]}")
+
 
+def getGeoParquetMetadata(geometry_column: str, geometry_types: list[str]):
+    """
+    return GeoParquet 1.0.0 file metadata of a WKB encoded geometry column in longitude/latitude (OGC:CRS84, the default crs)
+    """
+    return {"version": "1.0.0", "primary_column": geometry_column, "columns": {geometry_column: {
+        "encoding": "WKB", "geometry_types": geometry_types}}}
 
-def exportDataFrameToFile(df: DataFrame, fileType: str, exportName: str):
+
+def writeGeoParquet(batches, filepath: str, geometry_column: str = "geometry", lat_column: str = "latitude", long_column: str = "longitude", compression: str = default_compression, geometry_types: list[str] = [], schema: pa.Schema = None):
+    """
+    write batches of rows as a GeoParquet file, one row group per batch.
+
+    Geometries are WKB encoded. Parameters are the same as `writeGeoJson`, `geometry_types` (e.g. ["Point"]) is left
+    empty when they are unknown and `schema` is the `getArrowSchema` of the whole DataFrame without its geometry column.
+    Without a schema, the types of the first batch are used for the whole file.
+    """
+    writer = None
+    try:
+        for batch in batches:
+            geometries = getBatchGeometry(
+                batch, geometry_column, lat_column, long_column)
+            properties = DataFrame(batch).drop(
+                columns=[geometry_column], errors="ignore")
+            if (schema is None):
+                schema = getArrowSchema(properties)
+            table = getArrowTable(properties, schema)
+            table = table.append_column(geometry_column, pa.array(
+                shapely.to_wkb(geometries), type=pa.binary()))
+            if (writer is None):
+                writer = pq.ParquetWriter(filepath, table.schema.with_metadata(dict(table.schema.metadata or {}, geo=json.dumps(
+                    getGeoParquetMetadata(geometry_column, geometry_types)))), compression=compression, use_dictionary=True)
+            writer.write_table(table)
+    finally:
+        if (writer is not None):
+            writer.close()
+
+
+def openOutputStream(filepath: str, compression: str = "none"):
+    """
+    return binary arrow output stream of a file, compressed on the fly with "gzip" or "zstd"
+    """
+    return pa.output_stream(filepath, compression=None if compression == "none" else compression)
+
+
+def writeCsv(batches, filepath: str, compression: str = "none", columns: list[str] = None):
+    """
+    write batches of rows to a csv file with a single header, optionally gzip or zstd compressed.
+
+    The header is written from `columns` when there are no batches, e.g. for an empty DataFrame.
+    """
+    with openOutputStream(filepath, compression) as f:
+        header = True
+        for batch in batches:
+            f.write(batch.to_csv(index=False, header=header).encode("utf-8"))
+            header = False
+        if (header and columns is not None):
+            f.write(DataFrame(columns=columns).to_csv(
+                index=False).encode("utf-8"))
+
+
+def writeNdjson(batches, filepath: str, compression: str = "none"):
+    """
+    write batches of rows to a JSON Lines file, one JSON object per row, optionally gzip or zstd compressed.
+
+    Each batch is encoded by the pandas C json encoder with the same value formats as the json export.
+    """
+    with openOutputStream(filepath, compression) as f:
+        for batch in batches:
+            lines = batch.to_json(orient="records", lines=True)
+            if (not lines.endswith("\n")):
+                lines += "\n"
+            f.write(lines.encode("utf-8"))
+
+
+def writeXlsx(batches, filepath: str, sheet_name: str = "Sheet1", columns: list[str] = None):
+    """
+    write batches of rows to an xlsx workbook with a write-only openpyxl workbook, one row at a time.
+
+    Rows are streamed to the file instead of building the whole workbook in memory. Missing values are written
+    as empty cells and values excel cannot hold, such as lists or timezone aware dates, as text.
+    The header is written from `columns` when there are no batches, e.g. for an empty DataFrame.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    header = False
+    for batch in batches:
+        if (not header):
+            sheet.append([str(x) for x in batch.columns])
+            header = True
+        values = batch.astype(object).where(batch.notna(), None)
+        for column, dtype in batch.dtypes.items():
+            if (isinstance(dtype, DatetimeTZDtype) or (dtype == object and values[column].map(lambda x: isinstance(x, (list, dict, tuple)) or getattr(x, "tzinfo", None) is not None).any())):
+                values[column] = values[column].map(
+                    lambda x: str(x) if x is not None else x)
+        for row in values.itertuples(index=False, name=None):
+            sheet.append(row)
+    if (not header and columns is not None):
+        sheet.append([str(x) for x in columns])
+    workbook.save(filepath)
+
+
+def isCompressionSupported(fileType: str, compression: str = None):
+    """
+    return whether files of a format can be written with a compression, to be checked before any data is processed
+    """
+    return compression not in unsupported_compressions.get(fileType, [])
+
+
+def exportDataFrameToFile(df: DataFrame, fileType: str, exportName: str, compression: str = None):
     """ 
-    Export DataFrame to file[csv, json]
+    Export DataFrame to file[csv, json, ndjson, parquet, arrow, geojson, geoparquet, xlsx]
 
     Parameters
     -----------
 
     df: Pandas DataFrame object
-    fileType: Export format which can be either "csv" or "json"
+    fileType: Export format which can be either "csv", "json", "ndjson" (JSON Lines), "parquet", "arrow" (Arrow IPC/Feather), "geojson", "geoparquet" or "xlsx".
+    Geographic formats use the geometry of a GeoDataFrame, or points from the `longitude` and `latitude` columns.
     exportName: Export file name or File location
+    compression: (optional) "none", "gzip" or "zstd". Parquet and arrow files are compressed with `default_compression`
+    and csv and ndjson files are not compressed if not given.
     """
+    if (not isCompressionSupported(fileType, compression)):
+        raise ValueError(
+            f"{fileType} files cannot be compressed with {compression}")
+    text_compression = compression or "none"
+    compression = compression or default_compression
     if (fileType == "csv"):
-        name = f"{exportName}.csv"
-        df.to_csv(name, index=False)
+        name = f"{exportName}.csv{text_compressions[text_compression]}"
+        writeCsv(iterFrameBatches(df), name,
+                 text_compression, columns=list(df.columns))
+        print(f"data export to {name}")
+    elif (fileType == "ndjson"):
+        name = f"{exportName}.ndjson{text_compressions[text_compression]}"
+        writeNdjson(iterFrameBatches(df), name, text_compression)
+        print(f"data export to {name}")
+    elif (fileType == "parquet"):
+        name = f"{exportName}.parquet"
+        pq.write_table(getArrowTable(df), name,
+                       compression=compression, use_dictionary=True)
+        print(f"data export to {name}")
+    elif (fileType == "arrow"):
+        name = f"{exportName}.arrow"
+        feather.write_feather(getArrowTable(
+            df), name, compression="uncompressed" if compression == "none" else compression)
+        print(f"data export to {name}")
+    elif (fileType == "xlsx"):
+        name = f"{exportName}.xlsx"
+        writeXlsx(iterFrameBatches(df), name, columns=list(df.columns))
+        print(f"data export to {name}")
+    elif (fileType in ["geojson", "geoparquet"]):
+        name = f"{exportName}.{fileType}"
+        geometry_column = df.geometry.name if isinstance(
+            df, GeoDataFrame) else "geometry"
+        if (fileType == "geojson"):
+            writeGeoJson(iterFrameBatches(df), name,
+                         geometry_column=geometry_column)
+        else:
+            writeGeoParquet(iterFrameBatches(df), name, geometry_column=geometry_column, compression=compression,
+                            geometry_types=[] if isinstance(df, GeoDataFrame) else ["Point"],
+                            schema=getArrowSchema(DataFrame(df).drop(columns=[geometry_column], errors="ignore")))
         print(f"data export to {name}")
     else:
         name = f"{exportName}.json"
         df.to_json(name, orient="records", index=False)
         print(f"data export to {name}")
+    return name
+
+
+def exportAndMeasure(df: DataFrame, fileType: str, exportName: str, compression: str = None):
+    """
+    return file name, size in bytes and seconds taken of a DataFrame exported with `exportDataFrameToFile`
+    """
+    start = monotonic()
+    name = exportDataFrameToFile(df, fileType, exportName, compression)
+    return name, os.path.getsize(name), monotonic() - start
+
+
+def parseOutputs(value: str, names: list[str]):
+    """
+    return dictionary of output name and path from a comma separated `--output` value.
+
+    Paths are given in the order of `names` ("path1, path2") or by name ("name2=path2, name1=path1"),
+    whitespace around them is removed and outputs without a path are left out.
+    """
+    outputs = {}
+    items = [x.strip() for x in (value or "").split(",")]
+    if (len(items) > len(names)):
+        raise ValueError(
+            f"{len(items)} outputs given, expected at most {len(names)}: {', '.join(names)}")
+    for position, item in enumerate(items):
+        name, separator, path = item.partition("=")
+        if (not separator):
+            name, path = names[position], item
+        name, path = name.strip(), path.strip()
+        if (name not in names):
+            raise ValueError(
+                f"unknown output {name}, expected one of {', '.join(names)}")
+        if (path):
+            outputs[name] = path
+    return outputs
+
+
+class OutputWriter:
+    """
+    Concurrent writer of the named outputs of a pipeline.
+
+    Outputs are exported as soon as they are submitted, on a thread pool for formats written by arrow or
+    pandas C code and on a process pool for formats serialised in python (`process_formats`), so a run
+    takes about the time of its slowest output instead of the sum of all of them.
+
+    Parameters
+    ----------
+    max_workers: (optional) number of outputs written at the same time by each pool
+    """
+
+    def __init__(self, max_workers: int = default_output_workers):
+        self.max_workers = max_workers
+        self._threads = None
+        self._processes = None
+        self._futures = {}
+
+    def submit(self, name: str, df: DataFrame, fileType: str, exportName: str, compression: str = None):
+        """
+        start exporting a DataFrame, DataFrames exported on threads must not be changed until `wait` returns
+        """
+        if (fileType in process_formats):
+            if (self._processes is None):
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.max_workers)
+            executor = self._processes
+        else:
+            if (self._threads is None):
+                self._threads = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            executor = self._threads
+        self._futures[name] = executor.submit(
+            exportAndMeasure, df, fileType, exportName, compression)
+
+    def wait(self):
+        """
+        return dictionary of output name and its file, bytes and seconds, once every output is written
+        """
+        metrics = {}
+        try:
+            for name, future in self._futures.items():
+                file, size, seconds = future.result()
+                metrics[name] = {"file": file, "bytes": size,
+                                 "seconds": round(seconds, 2)}
+                print(
+                    f"{name}: {file} ({size / 1e6:.1f} MB) in {seconds:.2f}s")
+        finally:
+            for executor in [self._threads, self._processes]:
+                if (executor is not None):
+                    executor.shutdown()
+            self._threads = None
+            self._processes = None
+            self._futures = {}
+        return metrics
 
 
 def useCartoM2M():
@@ -60,13 +429,290 @@ def getCartoClient(auth: CartoAuth):
     return auth.get_carto_dw_client()
 
 
-def uploadDataFrameToCarto(cartDW: Client, df: DataFrame, destination: str,  config):
+def getParquetBuffer(df: DataFrame, compression: str = default_compression, schema: pa.Schema = None):
+    """
+    return in-memory parquet file of a DataFrame, GeoDataFrames are written as GeoParquet.
+
+    `schema` is the `getArrowSchema` of the whole DataFrame (without its geometry column) when `df` is one of its chunks.
+    """
+    buffer = io.BytesIO()
+    if (isinstance(df, GeoDataFrame)):
+        writeGeoParquet([df], buffer, geometry_column=df.geometry.name,
+                        compression=compression, schema=schema)
+    else:
+        pq.write_table(getArrowTable(df, schema), buffer,
+                       compression=compression, use_dictionary=True)
+    buffer.seek(0)
+    return buffer
+
+
+def getUploadSchema(df: DataFrame):
+    """
+    return arrow schema of the columns of a DataFrame loaded into Carto, the geometry column of GeoDataFrames is left out
+    """
+    geometry_column = df.geometry.name if isinstance(
+        df, GeoDataFrame) else None
+    return getArrowSchema(DataFrame(df).drop(columns=[geometry_column] if geometry_column else []))
+
+
+class LocalLoadJob:
+    """
+    Finished job returned by `LocalLoadClient`, with the `job_id`, `result()` and `output_rows` of a bigquery job.
+    """
+
+    def __init__(self, job_id: str, output_rows: int):
+        self.job_id = job_id
+        self.output_rows = output_rows
+
+    def result(self, timeout: float = None):
+        return self
+
+
+class LocalLoadClient:
+    """
+    Local stand-in of the Carto data warehouse client, used to run and test uploads without network access.
+
+    Every loaded parquet file is read back and kept in `tables`, a dictionary of destination and list of arrow tables.
+    Like bigquery, a job id can only be used once and files appended with other column types than the table are rejected.
+
+    Parameters
+    ----------
+    failures: (optional) number of load requests that raise a ConnectionError before reaching the server
+    lost_responses: (optional) number of load requests whose job is run but whose response raises a ConnectionError
+    """
+
+    def __init__(self, failures: int = 0, lost_responses: int = 0):
+        self.tables = {}
+        self.jobs = {}
+        self.failures = failures
+        self.lost_responses = lost_responses
+        self._lock = threading.Lock()
+
+    def _addJob(self, job_id: str, output_rows: int):
+        if (job_id in self.jobs):
+            raise Conflict(f"Already Exists: Job {job_id}")
+        job = LocalLoadJob(job_id or uuid.uuid4().hex, output_rows)
+        self.jobs[job.job_id] = job
+        return job
+
+    def load_table_from_file(self, file_obj, destination: str, job_id: str = None, job_config=None):
+        with self._lock:
+            if (self.failures > 0):
+                self.failures -= 1
+                raise ConnectionError("load request failed")
+        table = pq.read_table(file_obj)
+        with self._lock:
+            existing = self.tables.get(destination, [])
+            if (getattr(job_config, "write_disposition", None) == "WRITE_TRUNCATE"):
+                existing = []
+            if (len(existing) > 0 and not existing[0].schema.equals(table.schema, check_metadata=False)):
+                raise ValueError(
+                    f"schema of the file does not match the schema of {destination}")
+            job = self._addJob(job_id, table.num_rows)
+            self.tables[destination] = existing + [table]
+            if (self.lost_responses > 0):
+                self.lost_responses -= 1
+                raise ConnectionError("load response lost")
+        return job
+
+    def copy_table(self, sources: str, destination: str, job_id: str = None, job_config=None):
+        with self._lock:
+            disposition = getattr(
+                job_config, "write_disposition", None) or "WRITE_EMPTY"
+            if (disposition == "WRITE_EMPTY" and len(self.tables.get(destination, [])) > 0):
+                raise ValueError(f"{destination} is not empty")
+            existing = [] if disposition == "WRITE_TRUNCATE" else self.tables.get(
+                destination, [])
+            job = self._addJob(job_id, sum(
+                [x.num_rows for x in self.tables[sources]]))
+            self.tables[destination] = existing + self.tables[sources]
+        return job
+
+    def get_job(self, job_id: str):
+        return self.jobs[job_id]
+
+    def delete_table(self, table: str, not_found_ok: bool = False):
+        with self._lock:
+            if (table not in self.tables and not not_found_ok):
+                raise KeyError(f"Not found: Table {table}")
+            self.tables.pop(table, None)
+
+    def getTable(self, destination: str):
+        """
+        return DataFrame of every file loaded into a destination
+        """
+        return pa.concat_tables(self.tables[destination]).to_pandas()
+
+
+class CartoUploader:
+    """
+    Chunked Carto data warehouse uploader.
+
+    DataFrames are written to parquet in chunks of `chunk_rows` rows, all with the arrow schema of the whole DataFrame,
+    and loaded with concurrent load jobs into a staging table. Once every chunk is loaded, the staging table is copied
+    into the destination with the write disposition of the job config (e.g. WRITE_TRUNCATE) in a single copy job and
+    deleted, so a failed upload leaves the destination unchanged.
+
+    Jobs have fixed ids and only requests that may have been lost (`transient_errors`) are retried, with exponential
+    backoff and the same job id, so a job that already ran is not run twice. Failed jobs are raised.
+
+    Parameters
+    ----------
+    client: Carto data warehouse client, or any client with the load, copy, get job and delete table methods of `LocalLoadClient`
+    chunk_rows: (optional) rows per parquet file
+    max_workers: (optional) number of concurrent load jobs
+    retries: (optional) retries per job request
+    backoff: (optional) seconds before the first retry, doubled on every retry
+    """
+
+    def __init__(self, client: Client, chunk_rows: int = default_upload_chunk_rows, max_workers: int = default_upload_workers, retries: int = default_upload_retries, backoff: float = default_upload_backoff):
+        self.client = client
+        self.chunk_rows = chunk_rows
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+
+    def _runJob(self, job_id: str, submit):
+        """
+        return number of retries of the request of a job, once the job has finished
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                job = submit(job_id)
+                break
+            except Conflict:
+                # the job was created by an earlier request whose response was lost
+                job = self.client.get_job(job_id)
+                break
+            except transient_errors as e:
+                if (attempt == self.retries):
+                    raise e
+                print(f"request of job {job_id} failed ({e}), retrying")
+                sleep(self.backoff * (2 ** attempt) +
+                      random.uniform(0, self.backoff))
+        job.result()
+        return attempt
+
+    def _loadChunk(self, chunk: DataFrame, staging: str, config, schema: pa.Schema, job_id: str, metrics: dict):
+        buffer = getParquetBuffer(chunk, schema=schema)
+        size = buffer.getbuffer().nbytes
+
+        def submit(job_id: str):
+            buffer.seek(0)
+            return self.client.load_table_from_file(buffer, destination=staging, job_id=job_id, job_config=config)
+        retries = self._runJob(job_id, submit)
+        with self._lock:
+            metrics["rows"] += len(chunk)
+            metrics["bytes"] += size
+            metrics["chunks"] += 1
+            metrics["retries"] += retries
+
+    def upload(self, df: DataFrame, destination: str, config, schema: pa.Schema = None):
+        """
+        return metrics of the upload of a DataFrame: rows, bytes, chunks, retries, seconds and MB per second.
+
+        `schema` is the `getUploadSchema` of the DataFrame the rows come from, e.g. the whole table when only
+        some of its rows are uploaded, computed from `df` when not given.
+        """
+        metrics = {"rows": 0, "bytes": 0, "chunks": 0, "retries": 0}
+        start = monotonic()
+        upload_id = f"aurora_upload_{uuid.uuid4().hex}"
+        staging = f"{destination}_{upload_id}"
+        if (schema is None):
+            schema = getUploadSchema(df)
+        config = copy.deepcopy(config)
+        config.source_format = SourceFormat.PARQUET
+        disposition = getattr(config, "write_disposition",
+                              None) or "WRITE_APPEND"
+        config.write_disposition = "WRITE_TRUNCATE"
+        chunks = enumerate(iterFrameBatches(df, self.chunk_rows))
+        # an empty DataFrame is loaded as an empty staging table, so that WRITE_TRUNCATE still empties the destination
+        position, first = next(chunks, (0, df.iloc[:0]))
+        try:
+            self._loadChunk(first, staging, config, schema,
+                            f"{upload_id}_{position}", metrics)
+            append_config = copy.deepcopy(config)
+            append_config.write_disposition = "WRITE_APPEND"
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._loadChunk, chunk, staging, append_config, schema, f"{upload_id}_{position}", metrics)
+                           for position, chunk in chunks]
+                for future in futures:
+                    future.result()
+            metrics["retries"] += self._runJob(f"{upload_id}_copy", lambda job_id: self.client.copy_table(
+                staging, destination, job_id=job_id, job_config=CopyJobConfig(write_disposition=disposition)))
+        finally:
+            self.client.delete_table(staging, not_found_ok=True)
+        metrics["seconds"] = round(monotonic() - start, 2)
+        metrics["mb_per_second"] = round(
+            metrics["bytes"] / 1e6 / metrics["seconds"], 2) if metrics["seconds"] > 0 else None
+        return metrics
+
+
+def uploadDataFrameToCarto(cartDW: Client, df: DataFrame, destination: str,  config, upload_format: str = "geoparquet", schema: pa.Schema = None):
+    """
+    upload DataFrame to a Carto data warehouse table and wait for it to finish.
+
+    With `upload_format="geoparquet"` the DataFrame is loaded in parquet chunks by a `CartoUploader`,
+    the geometry column of GeoDataFrames is loaded as GEOGRAPHY, and the upload metrics are returned.
+    `schema` gives the column types of the chunks, see `CartoUploader.upload`.
+    """
+    if (upload_format == "geoparquet"):
+        metrics = CartoUploader(cartDW).upload(
+            df, destination, config, schema=schema)
+        print(
+            f"uploaded {metrics['rows']} rows ({metrics['bytes'] / 1e6:.1f} MB in {metrics['chunks']} chunks) to {destination} in {metrics['seconds']}s, {metrics['mb_per_second']} MB/s")
+        return metrics
     job = cartDW.load_table_from_dataframe(
         dataframe=df, destination=destination, job_config=config)
+    job.result()
     print("uploaded to "+destination)
     return job
 
 
+def getMergeQuery(destination: str, staging: str, key_column: str, columns: list[str]):
+    """
+    return BigQuery MERGE statement upserting the rows of a staging table into a table by key
+    """
+    updates = ", ".join([f"`{x}` = S.`{x}`" for x in columns if x != key_column])
+    return f"MERGE `{destination}` T USING `{staging}` S ON T.`{key_column}` = S.`{key_column}` WHEN MATCHED THEN UPDATE SET {updates} WHEN NOT MATCHED THEN INSERT ROW"
+
+
+def uploadIncrementalToCarto(cartDW: Client, df: DataFrame, destination: str, config, key_column: str):
+    """
+    upload only the rows of a DataFrame that are new or changed since the last upload to a Carto data warehouse table.
+
+    Every row is fingerprinted with `getRowHashes` and compared with the `UploadManifest` of the destination.
+    Changed rows are loaded into a `{destination}_staging` table, with the column types of the whole DataFrame so that
+    they match the destination, and upserted into the destination on `key_column` with a MERGE statement. The whole table is uploaded with `config` when there is no manifest yet, when rows were
+    removed or when keys are not unique.
+    """
+    manifest = UploadManifest(destination)
+    keys = df[key_column]
+    hashes = getRowHashes(df)
+    changed, removed = manifest.getChanges(keys, hashes)
+    if (not manifest.exists() or len(removed) > 0 or keys.duplicated().any()):
+        print(f"uploading the whole table to {destination}")
+        metrics = uploadDataFrameToCarto(cartDW, df, destination, config)
+    elif (not changed.any()):
+        print(f"no rows changed since the last upload to {destination}")
+        return {"rows": 0, "bytes": 0}
+    else:
+        staging = f"{destination}_staging"
+        staging_config = copy.deepcopy(config)
+        staging_config.write_disposition = "WRITE_TRUNCATE"
+        metrics = uploadDataFrameToCarto(
+            cartDW, df[changed], staging, staging_config, schema=getUploadSchema(df))
+        start = monotonic()
+        cartDW.query(getMergeQuery(destination, staging,
+                     key_column, list(df.columns))).result()
+        cartDW.delete_table(staging, not_found_ok=True)
+        print(
+            f"merged {changed.sum()} new or changed rows into {destination} in {monotonic() - start:.2f}s")
+    manifest.save(keys, hashes)
+    return metrics
+
+
 def getCartoToken(auth: CartoAuth):
     return auth.get_access_token()
 
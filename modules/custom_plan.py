@@ -0,0 +1,296 @@
+import numpy as np
+from pandas import DataFrame, Series, read_csv
+from .custom_functions import valueLabelChange, mapUniqueValues, replaceOrganisation, processMultValueColumns
+from .custom_defaults import defaults_dir, getDefaultsRegistry
+from .custom_time import parseTimestamps
+
+# steps that change the values of a single column one value at a time
+column_operations = ["replace", "replace_values", "capitalise"]
+frame_operations = ["replace_organisation", "fill_missing",
+                    "filter", "timestamp", "codify"]
+
+
+def resolveReferences(value, params: dict, directory: str = defaults_dir):
+    """
+    return plan value with `{"$ref": "file.json#property"}` objects replaced by the content of the
+    referenced defaults file and `"$name"` strings replaced by the parameter of that name
+    """
+    if (type(value) == dict):
+        if ("$ref" in value):
+            filename, _, dataProp = value["$ref"].partition("#")
+            return getDefaultsRegistry(directory).get(filename, dataProp)
+        return {key: resolveReferences(item, params, directory) for key, item in value.items()}
+    if (type(value) == list):
+        return [resolveReferences(item, params, directory) for item in value]
+    if (type(value) == str and value.startswith("$") and value[1:] in params):
+        return params[value[1:]]
+    return value
+
+
+def getColumnFunction(step: dict, column: str):
+    """
+    return function applied to every unique value of a column by a column step
+    """
+    op = step["op"]
+    if (op == "replace"):
+        values = step["values"]
+        return lambda x: values.get(x, x) if isinstance(x, str) else x
+    if (op == "replace_values"):
+        values = step["columns"][column]
+        other_value = step.get("other_value", "Otro")
+        return lambda x: valueLabelChange(x, values, other_value)
+    if (op == "capitalise"):
+        return lambda x: x.title() if isinstance(x, str) else x
+    raise ValueError(f"unknown column operation {op}")
+
+
+def getStepColumns(step: dict):
+    """
+    return columns read and columns written by a step, using the column names of the plan
+    """
+    op = step["op"]
+    if (op == "replace"):
+        return [step["column"]], [step["column"]]
+    if (op == "replace_values"):
+        columns = list(step["columns"].keys())
+        return columns, columns
+    if (op == "capitalise"):
+        return list(step["columns"]), list(step["columns"])
+    if (op == "replace_organisation"):
+        return [step["column"], step["replacement_column"]], [step["column"]]
+    if (op == "fill_missing"):
+        return [step["column"], step["where"]["column"]], [step["column"]]
+    if (op == "filter"):
+        return [step["column"]], []
+    if (op == "timestamp"):
+        return [step["column"]], [step["output_column"]]
+    if (op == "codify"):
+        configs = step["columns"].values()
+        return [x["target_column"] for x in configs], [x["output_column"] for x in configs]
+    if (op in ["rename", "drop"]):
+        return [], []
+    raise ValueError(f"unknown operation {op}")
+
+
+class TransformationPlan:
+    """
+    Declarative sequence of transformation steps compiled into a fused pipeline.
+
+    Steps refer to columns by the name they have at that point of the plan. When compiled, rename
+    steps are folded into a single rename at the end, consecutive column steps on the same column are
+    merged into one pass over its unique values, row filters run right after the steps they depend on,
+    and dropped columns are not read from the source file or are released right after their last use.
+
+    Parameters
+    ----------
+    plan: dictionary with `steps`, and optionally `read` options of `read_csv`, `params` defaults and
+    `columns`, the only output columns to keep
+    params: (optional) values of the `"$name"` placeholders of the plan
+    directory: (optional) location of the files referenced with `$ref`
+    """
+
+    def __init__(self, plan: dict, params: dict = {}, directory: str = defaults_dir):
+        self.params = dict(plan.get("params", {}), **params)
+        self.read_options = plan.get("read", {})
+        steps = resolveReferences(plan["steps"], self.params, directory)
+        keep = plan.get("columns")
+        self._compile(steps, keep)
+
+    def _compile(self, steps: list[dict], keep: list[str] = None):
+        # name of a column in the plan -> name of the column in the frame, None when it was renamed away or dropped
+        aliases = {}
+
+        def lookup(column: str):
+            return aliases.get(column, column)
+
+        internal_steps = []
+        dropped = []
+        for step in steps:
+            op = step["op"]
+            if (op == "rename"):
+                resolved = {new: lookup(old)
+                            for old, new in step["columns"].items()}
+                for old in step["columns"]:
+                    aliases[old] = None
+                aliases.update(resolved)
+                continue
+            if (op == "drop"):
+                dropped += [lookup(x) for x in step["columns"]
+                            if lookup(x) is not None]
+                for column in step["columns"]:
+                    aliases[column] = None
+                continue
+            reads, writes = getStepColumns(step)
+            internal_steps.append(
+                (step, {column: lookup(column) for column in reads + writes}))
+
+        self.rename = {source: column for column, source in aliases.items()
+                       if source is not None and source != column}
+        self.keep = set([lookup(x) for x in keep]) if keep is not None else None
+        self.dropped = set(dropped)
+        self.stages = self._schedule(internal_steps)
+
+    def _isNeeded(self, column: str):
+        if (column is None or column in self.dropped):
+            return False
+        return self.keep is None or column in self.keep
+
+    def _schedule(self, internal_steps: list):
+        """
+        return ordered stages: ("filter", step, column), ("frame", step, columns), ("columns", {column: [functions]}) and ("drop", [columns])
+        """
+        stages = []
+        filters = []
+        pending = {}
+        last_write = {}
+        last_use = {}
+
+        def flush(columns: list[str]):
+            chains = {column: pending.pop(column)
+                      for column in columns if column in pending}
+            if (len(chains) > 0):
+                for column in chains:
+                    last_write[column] = len(stages)
+                stages.append(("columns", chains))
+
+        for step, columns in internal_steps:
+            op = step["op"]
+            reads, writes = getStepColumns(step)
+            if (op == "filter"):
+                # a filter only has to wait for the steps writing its column
+                column = columns[step["column"]]
+                flush([column])
+                filters.append(
+                    (last_write.get(column, -1) + 1, len(filters), step, column))
+                continue
+            if (op in column_operations):
+                for column in writes:
+                    if (self._isNeeded(columns[column])):
+                        pending.setdefault(columns[column], []).append(
+                            getColumnFunction(step, column))
+                continue
+            if (not any(self._isNeeded(columns[column]) for column in writes)):
+                continue
+            flush([columns[column] for column in reads + writes])
+            for column in reads:
+                last_use[columns[column]] = len(stages)
+            for column in writes:
+                last_write[columns[column]] = len(stages)
+            stages.append(("frame", step, columns))
+        flush(list(pending.keys()))
+
+        for position, _, step, column in sorted(filters, reverse=True):
+            stages.insert(position, ("filter", step, column))
+            last_use = {key: value + 1 if value >= position else value
+                        for key, value in last_use.items()}
+            last_use[column] = max(last_use.get(column, -1), position)
+
+        # columns read by a step are needed even when they are not part of the output
+        self.used = set(last_use.keys()) | set(
+            [column for stage in stages if stage[0] == "columns" for column in stage[1]])
+
+        # dropped columns that are read by a step are released right after their last use
+        releases = {}
+        for column in self.dropped:
+            if (column in last_use):
+                releases.setdefault(last_use[column], []).append(column)
+        for position in sorted(releases.keys(), reverse=True):
+            stages.insert(position + 1, ("drop", releases[position]))
+        return stages
+
+    def usecols(self, column: str):
+        """
+        return whether a source column has to be read, to be used as `read_csv(usecols=...)`
+        """
+        if (column in self.used):
+            return True
+        if (self.keep is not None):
+            return column in self.keep
+        return column not in self.dropped
+
+    def readCsv(self, filepath: str, **kwargs):
+        """
+        return DataFrame of a csv file read with the plan read options and only the needed columns
+        """
+        return read_csv(filepath, usecols=self.usecols, **dict(self.read_options, **kwargs))
+
+    def execute(self, df: DataFrame):
+        """
+        return DataFrame transformed by the plan
+        """
+        local_df = df.drop(columns=[column for column in df.columns if not self.usecols(column)])
+        for stage in self.stages:
+            kind = stage[0]
+            if (kind == "filter"):
+                _, step, column = stage
+                local_df = local_df[~local_df[column].isin(step["exclude"])]
+            elif (kind == "columns"):
+                for column, functions in stage[1].items():
+                    if (column in local_df.columns):
+                        local_df[column] = applyColumnFunctions(
+                            local_df[column], functions)
+            elif (kind == "drop"):
+                local_df = local_df.drop(columns=stage[1])
+            else:
+                _, step, columns = stage
+                local_df = executeFrameStep(local_df, step, columns)
+        local_df = local_df.drop(columns=[column for column in local_df.columns
+                                          if column in df.columns and not self._isNeeded(column)])
+        return local_df.rename(columns=self.rename)
+
+    def executeBatches(self, batches):
+        """
+        yield DataFrames transformed by the plan, one per batch of rows, e.g. from `readCsv(..., chunksize=...)`.
+        Every step works row by row, so the concatenated batches are the same as the whole DataFrame transformed.
+        """
+        for df in batches:
+            yield self.execute(df)
+
+
+def applyColumnFunctions(dfColumn: Series, functions: list):
+    """
+    return column with the functions applied in order, once per unique value.
+    The column is returned unchanged when no value changes.
+    """
+    def apply(value):
+        for function in functions:
+            value = function(value)
+        return value
+
+    output = mapUniqueValues(dfColumn, apply)
+    if (output.equals(dfColumn)):
+        return dfColumn
+    return output
+
+
+def executeFrameStep(df: DataFrame, step: dict, columns: dict[str, str]):
+    """
+    return DataFrame with a step that reads several columns applied, `columns` maps plan names to frame names
+    """
+    op = step["op"]
+    if (op == "replace_organisation"):
+        return replaceOrganisation(df, step["value"], columns[step["column"]], columns[step["replacement_column"]], inplace=True)
+    if (op == "fill_missing"):
+        column = columns[step["column"]]
+        where = step["where"]
+        condition = (df[columns[where["column"]]] == where["equals"]).to_numpy() & \
+            df[column].isnull().to_numpy()
+        df[column] = np.where(condition, step["value"],
+                              df[column].to_numpy(dtype=object))
+        return df
+    if (op == "timestamp"):
+        df[step["output_column"]] = parseTimestamps(
+            df[columns[step["column"]]], [step["format"]])["timeunix"]
+        return df
+    if (op == "codify"):
+        configs = {key: dict(config, target_column=columns[config["target_column"]])
+                   for key, config in step["columns"].items()}
+        return processMultValueColumns(df, configs, mode=step.get("mode", "codes"))
+    raise ValueError(f"unknown operation {op}")
+
+
+def loadTransformationPlan(filename: str, params: dict = {}, directory: str = defaults_dir):
+    """
+    return compiled TransformationPlan from a JSON plan file in `directory`
+    """
+    return TransformationPlan(getDefaultsRegistry(directory).get(filename), params=params, directory=directory)
@@ -0,0 +1,85 @@
+import numpy as np
+from pandas import DataFrame, Series, NaT, to_datetime
+
+# formats of "Inicio interacción" in the Aurora exports
+interaction_formats = ["%Y-%m-%d %H:%M:%S.%f+00:00",
+                       "%d/%m/%Y %H:%M:%S.%f+00:00"]
+
+day_format = "%Y-%m-%d"
+
+
+def getSwappedFormat(format: str):
+    """
+    return format with day and month directives swapped, or None when the format cannot be read both ways.
+
+    Formats starting with a `%Y-%m-%d` date follow ISO 8601 and are not considered ambiguous.
+    """
+    if ("%d" not in format or "%m" not in format or format.startswith("%Y-%m-%d")):
+        return None
+    return format.replace("%d", "\0").replace("%m", "%d").replace("\0", "%m")
+
+
+def parseTimestamps(dfColumn: Series, formats: list[str], unit: str = "s"):
+    """
+    return DataFrame with the epoch milliseconds (`timeunix`), the day string (`fecha`) and the ambiguity flag (`ambiguous`)
+    of every value of a date column.
+
+    Every unique value is parsed once. Formats are tried in order on whole columns, each one only on
+    the values no previous format could parse. Values without a timezone are read as UTC. A value is
+    ambiguous when reading it with day and month swapped also gives a valid but different date, e.g.
+    "05/11/2023" is the 5th of November with "%d/%m/%Y" and the 11th of May with "%m/%d/%Y".
+
+    Parameters
+    ----------
+    dfColumn: column of date strings
+    formats: strptime formats tried in order
+    unit: (optional) "s" to truncate `timeunix` to seconds, "D" to truncate it to the day
+    """
+    codes, uniques = dfColumn.factorize()
+    uniques = Series(np.asarray(uniques, dtype=object))
+    parsed = Series(NaT, index=uniques.index, dtype="datetime64[ns, UTC]")
+    ambiguous = np.zeros(len(uniques) + 1, dtype=bool)
+    pending = (uniques.map(type) == str).to_numpy()
+    for format in formats:
+        if (not pending.any()):
+            break
+        values = uniques[pending]
+        current = to_datetime(values, format=format,
+                              errors="coerce", utc=True)
+        matched = current.notna().to_numpy()
+        parsed[values.index[matched]] = current[matched]
+        swapped_format = getSwappedFormat(format)
+        if (swapped_format is not None and matched.any()):
+            swapped = to_datetime(values[matched], format=swapped_format,
+                                  errors="coerce", utc=True)
+            ambiguous[values.index[matched]] = (
+                swapped.notna() & (swapped != current[matched])).to_numpy()
+        pending[values.index[matched]] = False
+
+    truncated = parsed.dt.floor("D") if unit == "D" else parsed.dt.floor("s")
+    missing = truncated.isna().to_numpy()
+    milliseconds = np.append(truncated.to_numpy(
+        dtype="datetime64[ms]").astype(np.int64), 0)
+    days = np.append(parsed.dt.strftime(day_format).to_numpy(
+        dtype=object), np.nan)
+    missing = np.append(missing, True)
+
+    timeunix = Series(milliseconds[codes], index=dfColumn.index)
+    if (missing[codes].any()):
+        timeunix = timeunix.astype("Int64")
+        timeunix[missing[codes]] = None
+    return DataFrame({
+        "timeunix": timeunix,
+        "fecha": days[codes],
+        "ambiguous": ambiguous[codes],
+    }, index=dfColumn.index)
+
+
+def reportAmbiguous(dfColumn: Series, ambiguous: Series):
+    """
+    print the distinct values that could also be read with day and month swapped
+    """
+    values = dfColumn[ambiguous.to_numpy()].unique()
+    if (len(values) > 0):
+        print(
+            f"{ambiguous.sum()} dates could also be read with day and month swapped, e.g. {', '.join([str(x) for x in values[:5]])}")
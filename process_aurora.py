@@ -1,8 +1,12 @@
 import sys
-from pandas import merge, read_csv, read_json
-from modules.custom_functions import loadLocalJsonDoc, processCountries,  toUnixTimestamp
-from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame, processFieldCoordinates, getCountriesWithCoordinates
-from modules.custom_io import uploadDataFrameToCarto, getCartoClient, useCartoAuth, exportDataFrameToFile
+from pandas import merge
+from modules.custom_csv import loadSchema, readCsvWithSchema
+from modules.custom_defaults import loadDefault, loadCompiledDefault
+from modules.custom_time import parseTimestamps
+from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame, processFieldCoordinates
+from modules.custom_cache import GeocodeCache, GeocodeJournal
+from modules.custom_geocoder import getOfflineGeocoder
+from modules.custom_io import uploadDataFrameToCarto, uploadIncrementalToCarto, getCartoClient, useCartoAuth, exportDataFrameToFile, export_formats, compressions, isCompressionSupported
 import os
 from google.cloud import bigquery
 from argparse import ArgumentParser
@@ -10,53 +14,38 @@ from argparse import ArgumentParser
 defaultMissingValue = 999999
 
 
-def main(cara_path: str, feedback_path: str, destination: str = "", output_path: str = "", output_format: str = "csv"):
+def main(cara_path: str, feedback_path: str, destination: str = "", output_path: str = "", output_format: str = "csv", resume: bool = False, incremental: bool = False, compression: str = None):
 
-    working_dir = os.getcwd()
-
-    # Import dataset
-    aurora_cara = read_csv(
-        filepath_or_buffer=cara_path)
-    aurora_feedback = read_csv(
-        filepath_or_buffer=feedback_path)
+    # Import dataset, columns of the aurora exports are typed with defaults/aurora_schema.json
+    schema = loadSchema()
+    aurora_cara = readCsvWithSchema(
+        filepath=cara_path, schema=schema)
+    aurora_feedback = readCsvWithSchema(
+        filepath=feedback_path, schema=schema)
 
     # merging first connection files (caracterization and feedback)
     aurora = merge(aurora_cara, aurora_feedback)
 
     # Drop observations of Aurora team phones, test registers and geographical atypical rows
-    user_ids_to_remove = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "test_user_ids.json"))
+    user_ids_to_remove = loadCompiledDefault("test_user_ids.json")
 
-    for user_id in user_ids_to_remove:
-        aurora = aurora.drop(aurora[aurora.UserId == user_id].index)
+    aurora = aurora[~aurora.UserId.isin(user_ids_to_remove)]
 
     # Filtering by geographical errors and informed consent
     aurora = aurora[aurora['Consentimiento'] != 'NO']
     aurora = aurora[aurora['Latitud'] != "None"]
     # Rename variables to be consistent with the first round exercise.
-    newColumns = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults", "aurora_column_name.json"))
+    newColumns = loadDefault("aurora_column_name.json")
 
     aurora_carto = aurora.rename(columns=newColumns)
     # Adding coordinates of variables (país de nacimiento, país donde inicio el viaje and país donde vivía hace un año)
 
-    available_countries = [x.lower() for x in list(set(list(aurora_carto["e08_pais_"].unique(
-    )) + list(aurora_carto["e10_pais_"].unique()) + list(aurora_carto["e12_pais_"].unique()))) if type(x) == str]
-
-    countries_dict = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults", "countries_dict.json"))
-
-    available_countries = processCountries(available_countries, countries_dict)
+    countries_dict = loadDefault("countries_dict.json")
 
-    country_df = read_json(
-        path_or_buf="defaults/countries.json", orient='records')
-
-    countriesWithCoordinates = getCountriesWithCoordinates(
-        available_countries, country_df)
-    country_column_dict = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults", "country_column_dict.json"))
+    # countries are normalized and looked up in the gazetteer once per unique value across all columns
+    country_column_dict = loadDefault("country_column_dict.json")
     aurora_carto = processFieldCoordinates(
-        aurora_carto, country_column_dict, countriesWithCoordinates, countries_dict)
+        aurora_carto, country_column_dict, expressionDict=countries_dict)
 
     aurora_carto['lon_eng'] = aurora_carto['lon']
     aurora_carto['lat_eng'] = aurora_carto['lat']
@@ -64,20 +53,23 @@ def main(cara_path: str, feedback_path: str, destination: str = "", output_path:
     aurora_carto['latitude'] = aurora_carto['lat']
     # Create the variable time
     # the format was missing other elements thus the timestring was not parsing
-    aurora_carto["timeunix"] = aurora_carto["Inicio interacción"].apply(
-        lambda x: toUnixTimestamp(x, '%Y-%m-%d %H:%M:%S.%f+00:00'))
+    aurora_carto["timeunix"] = parseTimestamps(
+        aurora_carto["Inicio interacción"], ['%Y-%m-%d %H:%M:%S.%f+00:00'])["timeunix"]
     # Adding coordinates of variables (país de nacimiento, país donde inicio el viaje and país donde vivía hace un año)
     MAPBOX_TOKEN = os.environ.get("MAPBOX_TOKEN")
     # This is heavy process that takes a while to finish
     # should be used sparingly and closer to end processes.
+    geocode_cache = GeocodeCache()
+    geocode_journal = GeocodeJournal(name="aurora", resume=resume)
     aurora_carto = addReverseGeocodedToDataFrame(
-        df=aurora_carto, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Auora")
+        df=aurora_carto, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Auora", cache=geocode_cache, geocoder=getOfflineGeocoder(), journal=geocode_journal)
+    geocode_cache.close()
+    geocode_journal.complete()
 
     # After checking some coordinates, especially in country borders where info was collected, and using some extra info as the name collector, there are some country names that were changed
     # This was did for Chile and Colombia
     # Colombia
-    user_ids_col = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "user_ids_col.json"))
+    user_ids_col = loadCompiledDefault("user_ids_col.json")
     condition_eng = '¿Cómo interactúa con el sistema?'
     condition_value = 'Enganche'
     new_country_value = 'Colombia'
@@ -87,8 +79,7 @@ def main(cara_path: str, feedback_path: str, destination: str = "", output_path:
     aurora_carto.loc[condition_col, 'country_name'] = new_country_value
 
    # Chile
-    user_ids_ch = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "user_ids_ch.json"))
+    user_ids_ch = loadCompiledDefault("user_ids_ch.json")
     new_country_value1 = 'Chile'
     condition1 = (aurora_carto['objectid'].isin(user_ids_ch)) & (
         aurora_carto[condition_eng] == condition_value)
@@ -119,7 +110,7 @@ def main(cara_path: str, feedback_path: str, destination: str = "", output_path:
 
     if (len(output_path) > 0):
         exportDataFrameToFile(
-            df=aurora_carto, fileType=output_format, exportName=output_path)
+            df=aurora_carto, fileType=output_format, exportName=output_path, compression=compression)
         return
 
     # database for Carto
@@ -133,8 +124,12 @@ def main(cara_path: str, feedback_path: str, destination: str = "", output_path:
 
         config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE",)
 
-        uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
-                               destination=destination, config=config)
+        if (incremental):
+            uploadIncrementalToCarto(cartDW=carto_client, df=output_df,
+                                     destination=destination, config=config, key_column="objectid")
+        else:
+            uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
+                                   destination=destination, config=config)
         return
 
     print("No file was exported")
@@ -151,8 +146,17 @@ if __name__ == "__main__":
     parser.add_argument('--output', type=str,
                         help='Output name or output path')
 
-    parser.add_argument('--format', type=str, choices=[
-                        'csv', 'json'], default='csv', help='Output format if output path is given')
+    parser.add_argument('--format', type=str, choices=export_formats,
+                        default='csv', help='Output format if output path is given')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip coordinates already geocoded by a previous interrupted run')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help='Upload only the rows that are new or changed since the last upload, merged into the destination on objectid')
+
+    parser.add_argument('--compression', type=str, choices=compressions,
+                        help='Compression of the output files: gzip or zstd for csv and ndjson, parquet and arrow are zstd compressed if not given')
 
     args = parser.parse_args()
 
@@ -161,6 +165,9 @@ if __name__ == "__main__":
     destination = args.destination
     output_path = args.output
     output_format = args.format
+    resume = args.resume
+    compression = args.compression
+    incremental = args.incremental
 
     if (not bool(cara_path)):
         print("Please add both Characterization data path")
@@ -170,9 +177,13 @@ if __name__ == "__main__":
         print("Please add both Feedback data path")
         sys.exit()
 
+    if (not isCompressionSupported(output_format, compression)):
+        print(f"{output_format} files cannot be compressed with {compression}")
+        sys.exit()
+
     if ((not bool(output_path)) & (not bool(destination))):
         print("Print add at least one output method")
         sys.exit()
 
     main(cara_path=cara_path, feedback_path=ayuda_path,
-         output_path=output_path, output_format=output_format, destination=destination)
+         output_path=output_path, output_format=output_format, destination=destination, resume=resume, incremental=incremental, compression=compression)
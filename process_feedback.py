@@ -1,10 +1,14 @@
 import sys
 import pandas as pd
-from pandas import merge, read_csv, read_json
-from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame, processFieldCoordinates, getCountriesWithCoordinates
-from modules.custom_io import useCartoAuth, uploadDataFrameToCarto, getCartoClient, exportDataFrameToFile, loadLocalJsonDoc
-from modules.custom_functions import toUnixTimestamp, processCountries
-from modules.custom_functions import toUnixTimestampMultiFormatted
+from pandas import merge
+from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame, processFieldCoordinates
+from modules.custom_cache import GeocodeCache, GeocodeJournal
+from modules.custom_geocoder import getOfflineGeocoder
+from modules.custom_io import useCartoAuth, uploadDataFrameToCarto, getCartoClient, OutputWriter, parseOutputs, export_formats, compressions, isCompressionSupported
+from modules.custom_functions import mapCodeLabels, mapLabelCodes, getEqualLengthMask
+from modules.custom_csv import loadSchema, readCsvWithSchema
+from modules.custom_defaults import loadDefault, loadCompiledDefault
+from modules.custom_time import parseTimestamps, reportAmbiguous, interaction_formats
 from google.cloud import bigquery
 import os
 from argparse import ArgumentParser
@@ -12,19 +16,18 @@ from datetime import datetime
 
 defaultMissingValue = 999999
 
-def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str, destinations: str = "", output_paths: str = "", output_format: str = "csv"):
-
-    working_dir = os.getcwd()
-
-    # Import dataset
-    aurora_cara = read_csv(
-        filepath_or_buffer=cara_path)
-    aurora_feedback = read_csv(
-        filepath_or_buffer=feedback_path)
-    aurora_monitoreos = read_csv(
-        filepath_or_buffer=monitoreo_path)
-    aurora_info = read_csv(
-        filepath_or_buffer=info_path)
+def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str, destinations: str = "", output_paths: str = "", output_format: str = "csv", resume: bool = False, panel_path: str = "", panel_format: str = "xlsx", compression: str = None):
+
+    # Import dataset, columns of the aurora exports are typed with defaults/aurora_schema.json
+    schema = loadSchema()
+    aurora_cara = readCsvWithSchema(
+        filepath=cara_path, schema=schema)
+    aurora_feedback = readCsvWithSchema(
+        filepath=feedback_path, schema=schema)
+    aurora_monitoreos = readCsvWithSchema(
+        filepath=monitoreo_path, schema=schema)
+    aurora_info = readCsvWithSchema(
+        filepath=info_path, schema=schema)
     
     # Dropping duplicates of monitorings (same answers differents days)
     columns_to_consider = [col for col in aurora_monitoreos.columns if col not in ['Inicio interacción', 'InteraID']]
@@ -41,24 +44,18 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
 
     # Drop observations of Aurora team phones, test registers and geographical atypical rows
 
-    user_ids_to_remove = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "test_user_ids.json"))
-
-    for user_id in user_ids_to_remove:
-        aurora_comple = aurora_comple.drop(
-            aurora_comple[aurora_comple.UserId == user_id].index)
+    user_ids_to_remove = loadCompiledDefault("test_user_ids.json")
 
-   # Variable of date in date format (for generating panel data)
-    aurora_comple["fecha"] = pd.to_datetime(
-        aurora_comple["Inicio interacción"],  errors='coerce', utc=True, infer_datetime_format=True).dt.strftime('%Y-%m-%d')
+    aurora_comple = aurora_comple[~aurora_comple.UserId.isin(user_ids_to_remove)]
 
-   # Variable of date in date format (for generating panel data)
-    aurora_comple["fecha"] = pd.to_datetime(
-        aurora_comple["Inicio interacción"],  errors='coerce', utc=True, infer_datetime_format=True).dt.strftime('%Y-%m-%d')
-
-    # fixing the format of nov 5th 2023 (monitorings) is different fron the rest of days
-    aurora_comple.loc[aurora_comple['fecha'] ==
-                      '2023-05-11', 'fecha'] = "2023-11-05"
+   # Variable of date in date format (for generating panel data) and time in unix timestamp
+    # day/month order comes from the format, so monitorings like 05/11/2023 are read as november 5th
+    interaction_times = parseTimestamps(
+        aurora_comple["Inicio interacción"], interaction_formats)
+    reportAmbiguous(aurora_comple["Inicio interacción"],
+                    interaction_times["ambiguous"])
+    aurora_comple["fecha"] = interaction_times["fecha"]
+    aurora_comple["timeunix"] = interaction_times["timeunix"]
 
     # Filling all observations of the same ID with the variable consent and actual country (variables of first connection)
     aurora_comple['Consentimiento'] = aurora_comple.groupby(
@@ -110,48 +107,34 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
 
 # Adding coordinates of variables (país de nacimiento, país donde inicio el viaje and país donde vivía hace un año)
 
-    available_countries = [x.lower() for x in list(set(list(aurora_comple["e08_pais_"].unique(
-    )) + list(aurora_comple["e10_pais_"].unique()) + list(aurora_comple["e12_pais_"].unique()))) if type(x) == str]
-
-    countries_dict = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults", "countries_dict.json"))
+    countries_dict = loadDefault("countries_dict.json")
 
-    available_countries = processCountries(available_countries, countries_dict)
-
-    country_df = read_json(
-        path_or_buf="defaults/countries.json", orient='records')
-
-    countriesWithCoordinates = getCountriesWithCoordinates(
-        available_countries, country_df)
-    country_column_dict = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults", "country_column_dict.json"))
+    # countries are normalized and looked up in the gazetteer once per unique value across all columns
+    country_column_dict = loadDefault("country_column_dict.json")
     aurora_comple = processFieldCoordinates(
-        aurora_comple, country_column_dict, countriesWithCoordinates, countries_dict)
+        aurora_comple, country_column_dict, expressionDict=countries_dict)
 
     aurora_comple['lon_eng'] = aurora_comple['Longitud']
     aurora_comple['lat_eng'] = aurora_comple['Latitud']
     aurora_comple['longitude'] = aurora_comple['Longitud']
     aurora_comple['latitude'] = aurora_comple['Latitud']
-    # Create the variable time
-    # the format was missing other elements thus the timestring was not parsing
-    possible_formats = ["%Y-%m-%d %H:%M:%S.%f+00:00",
-                        "%d/%m/%Y %H:%M:%S.%f+00:00"]
-    aurora_comple["timeunix"] = aurora_comple["Inicio interacción"].apply(
-        lambda x: toUnixTimestampMultiFormatted(time=str(x), formats=possible_formats))
 
     # Adding coordinates of variables (país de nacimiento, país donde inicio el viaje and país donde vivía hace un año)
     MAPBOX_TOKEN = os.environ.get("MAPBOX_TOKEN")
     # This is heavy process that takes a while to finish
     # should be used sparingly and closer to end processes.
     aurora_comple['objectid'] = aurora_comple['UserId']
+    geocode_cache = GeocodeCache()
+    geocode_journal = GeocodeJournal(name="feedback", resume=resume)
     aurora_comple = addReverseGeocodedToDataFrame(
-        df=aurora_comple, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Auora")
+        df=aurora_comple, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Auora", cache=geocode_cache, geocoder=getOfflineGeocoder(), journal=geocode_journal, precision=4)
+    geocode_cache.close()
+    geocode_journal.complete()
 
     # After checking some coordinates, especially in country borders where info was collected, and using some extra info as the name collector, there are some country names that were changed
     # This was did for Chile and Colombia
     # Colombia
-    user_ids_col = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "user_ids_col.json"))
+    user_ids_col = loadCompiledDefault("user_ids_col.json")
     condition_eng = '¿Cómo interactúa con el sistema?'
     condition_value = 'Enganche'
     new_country_value = 'Colombia'
@@ -161,8 +144,7 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
     aurora_comple.loc[condition_col, 'country_name'] = new_country_value
 
    # Chile
-    user_ids_ch = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "user_ids_ch.json"))
+    user_ids_ch = loadCompiledDefault("user_ids_ch.json")
     new_country_value1 = 'Chile'
     condition1 = (aurora_comple['UserId'].isin(user_ids_ch)) & (
         aurora_comple[condition_eng] == condition_value)
@@ -187,8 +169,12 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
     aurora_comple.loc[aurora_comple['UserId']
                       == 319708059, 'country_name'] = "Chile"
 
-    excel_file = 'completa.xlsx'
-    aurora_comple.to_excel(excel_file, index=False)
+    # outputs are written in the background while the next datasets are built
+    outputs = parseOutputs(output_paths, ["feedback", "feedback_nna"])
+    writer = OutputWriter()
+    if (panel_path):
+        writer.submit("completa", df=aurora_comple.copy(deep=False),
+                      fileType=panel_format, exportName=panel_path, compression=compression)
 
 # Dataset of general feedback
 
@@ -223,135 +209,40 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
     feedback['Satisfaccion'] = feedback['Satisfaccion'].str.split('|')
     feedback['Recomendacion'] = feedback['Recomendacion'].str.split('|')
 
-    df = pd.DataFrame(feedback)
-
-    df = df[df.apply(lambda row: all(row[['Ayuda', 'Acceso', 'Satisfaccion', 'Recomendacion']].str.len(
-    ) == row[['Ayuda', 'Acceso', 'Satisfaccion', 'Recomendacion']].str.len().iloc[0]), axis=1)]
+    # keep answers whose aid, access, satisfaction and recommendation lists have the same length
+    list_columns = ['Ayuda', 'Acceso', 'Satisfaccion', 'Recomendacion']
+    df = feedback[getEqualLengthMask(feedback, list_columns)]
 
-    df1 = df.explode(['Ayuda', 'Acceso', 'Satisfaccion', 'Recomendacion'])
+    df1 = df.explode(list_columns)
 
     df1['m14'] = df1['Acceso']
     df1['m15'] = df1['Satisfaccion']
 
-    # Change the variable of recomendation to be numeric, as the others using the values of first round
-    def change_variable_value(value):
-        if value == "SI":
-            return 1
-        elif value == "NO":
-            return 3
-        else:
-            return value
+    # code and label lookup tables, applied once per unique value of each column
+    feedback_values = loadDefault("feedback_values.json")
 
-    df1['m16'] = df1['Recomendacion'].apply(change_variable_value)
+    # Change the variable of recomendation to be numeric, as the others using the values of first round
+    df1['m16'] = mapLabelCodes(
+        df1['Recomendacion'], feedback_values["recommendation_codes"])
 
     # use dictionary for aid
-
-    nec_dict = {
-        1: "Agua",
-        2: "Alimentación o kit de alimentación",
-        3: "Alojamiento temporal",
-        4: "Asistencia legal",
-        5: "Ayuda psicológica",
-        6: "Dinero en efectivo",
-        7: "Duchas o baños",
-        8: "Educación o espacios educativos",
-        9: "Espacios seguros para adultos",
-        10: "Kit de aseo o elementos de higiene",
-        11: "Salud, primeros auxilios o atención médica",
-        12: "Transporte humanitario",
-        13: "Otra"
-    }
-
-    def necesidadMap(value):
-        try:
-
-            if (type(value) == int):
-                return nec_dict[value]
-            if (type(value) == str):
-                return nec_dict[int(value)]
-        except Exception as e:
-            return value
-
-    df1['Ayuda'] = df1['Ayuda'].apply(lambda x: necesidadMap(x))
+    df1['Ayuda'] = mapCodeLabels(df1['Ayuda'], feedback_values["aid_labels"])
 
     # adapt the variable use in Carto according to the first round dictionary
-    def aid_value_Carto(value):
-        if value == "Alimentación o kit de alimentación":
-            return 1
-        elif value == "Alojamiento temporal":
-            return 2
-        elif value == "Salud, primeros auxilios o atención médica":
-            return 3
-        elif value == "Agua":
-            return 4
-        elif value == "Duchas o baños":
-            return 5
-        elif value == "Kit de aseo o elementos de higiene":
-            return 6
-        elif value == "Asistencia legal":
-            return 7
-        elif value == "Ayuda psicológica":
-            return 8
-        elif value == "Dinero en efectivo":
-            return 9
-        elif value == "Transporte humanitario":
-            return 10
-        elif value == "Otra":
-            return 11
-        elif value == "Educación o espacios educativos":
-            return 12
-        elif value == "Espacios seguros para adultos":
-            return 13
-        else:
-            return value
-
-    df1['m12'] = df1['Ayuda'].apply(aid_value_Carto)
+    df1['m12'] = mapLabelCodes(df1['Ayuda'], feedback_values["aid_codes"])
 
     # use dictionary for access, satisfaction and recomendation
-
-    acc_dict = {
-        1: "Fácil",
-        2: "Regular",
-        3: "Difícil",
-    }
-
-    sat_dict = {
-        1: "Mucho",
-        2: "Poco",
-        3: "Nada",
-    }
-
-    def accMap(value):
-        try:
-
-            if (type(value) == int):
-                return acc_dict[value]
-            if (type(value) == str):
-                return acc_dict[int(value)]
-        except Exception as e:
-            return value
-
-    def satMap(value):
-        try:
-
-            if (type(value) == int):
-                return sat_dict[value]
-            if (type(value) == str):
-                return sat_dict[int(value)]
-        except Exception as e:
-            return value
-
-    df1['Acceso'] = df1['Acceso'].apply(lambda x: accMap(x))
-    df1['Satisfaccion'] = df1['Satisfaccion'].apply(lambda x: satMap(x))
+    df1['Acceso'] = mapCodeLabels(
+        df1['Acceso'], feedback_values["access_labels"])
+    df1['Satisfaccion'] = mapCodeLabels(
+        df1['Satisfaccion'], feedback_values["satisfaction_labels"])
 
     # filling missing values
     df1 = df1.fillna(defaultMissingValue)
 
-    feedback_output_path = output_paths.split(",")[0]
-
-    if (feedback_output_path):
-        exportDataFrameToFile(df=df1, fileType=output_format,
-                              exportName=feedback_output_path)
+    if ("feedback" in outputs):
+        writer.submit("feedback", df=df1, fileType=output_format,
+                      exportName=outputs["feedback"], compression=compression)
 
     # Children's services feedback
 
@@ -389,84 +280,40 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, info_path: str
     feedback_NNA['Recomendacion_NNA'] = feedback_NNA['Recomendacion_NNA'].str.split(
         '|')
 
-    df = pd.DataFrame(feedback_NNA)
+    list_columns = ['Ayuda_NNA', 'Acceso_NNA',
+                    'Satisfaccion_NNA', 'Recomendacion_NNA']
+    df = feedback_NNA[getEqualLengthMask(feedback_NNA, list_columns)]
 
-    df = df[df.apply(lambda row: all(row[['Ayuda_NNA', 'Acceso_NNA', 'Satisfaccion_NNA', 'Recomendacion_NNA']].str.len(
-    ) == row[['Ayuda_NNA', 'Acceso_NNA', 'Satisfaccion_NNA', 'Recomendacion_NNA']].str.len().iloc[0]), axis=1)]
-
-    df2 = df.explode(['Ayuda_NNA', 'Acceso_NNA',
-                     'Satisfaccion_NNA', 'Recomendacion_NNA'])
+    df2 = df.explode(list_columns)
 
     df2['m19'] = df2['Acceso_NNA']
     df2['m20'] = df2['Satisfaccion_NNA']
 
     # Change the variable of recomendation to be numeric, as the others
-
-    df2['m21'] = df2['Recomendacion_NNA'].apply(change_variable_value)
+    df2['m21'] = mapLabelCodes(
+        df2['Recomendacion_NNA'], feedback_values["recommendation_codes"])
 
     # use dictionary for children aid
-    aid_NNA_dict = {
-        1: "Agua",
-        2: "Alimentación o kit de alimentación",
-        3: "Alojamiento temporal",
-        4: "Ayuda psicológica",
-        5: "Duchas o baños",
-        6: "Educación o Espacios educativos y de cuidado para niños y niñas",
-        7: "Kit de aseo o elementos de higiene",
-        8: "Salud, primeros auxilios o atención médica",
-        9: "Otra"
-    }
+    df2['Ayuda_NNA'] = mapCodeLabels(
+        df2['Ayuda_NNA'], feedback_values["aid_nna_labels"])
 
-    def necesidadMap(value):
-        try:
-
-            if (type(value) == int):
-                return aid_NNA_dict[value]
-            if (type(value) == str):
-                return aid_NNA_dict[int(value)]
-        except Exception as e:
-            return value
+    # adapt the variable use in Carto according to the first round dictionary
+    df2['m18_1'] = mapLabelCodes(
+        df2['Ayuda_NNA'], feedback_values["aid_nna_codes"])
 
-    df2['Ayuda_NNA'] = df2['Ayuda_NNA'].apply(lambda x: necesidadMap(x))
+    df2['Acceso_NNA'] = mapCodeLabels(
+        df2['Acceso_NNA'], feedback_values["access_labels"])
+    df2['Satisfaccion_NNA'] = mapCodeLabels(
+        df2['Satisfaccion_NNA'], feedback_values["satisfaction_labels"])
 
-    # adapt the variable use in Carto according to the first round dictionary
-    def aidNNA_value_Carto(value):
-        if value == "Alimentación o kit de alimentación":
-            return 1
-        elif value == "Alojamiento temporal":
-            return 2
-        elif value == "Duchas o baños":
-            return 3
-        elif value == "Agua":
-            return 4
-        elif value == "Kit de aseo o elementos de higiene":
-            return 5
-        elif value == "Ayuda psicológica":
-            return 6
-        elif value == "Educación o Espacios educativos y de cuidado para niños y niñas":
-            return 7
-        elif value == "Salud, primeros auxilios o atención médica":
-            return 8
-        elif value == "Otra":
-            return 9
-        else:
-            return value
-
-    df2['m18_1'] = df2['Ayuda_NNA'].apply(aidNNA_value_Carto)
-
-    df2['Acceso_NNA'] = df2['Acceso_NNA'].apply(lambda x: accMap(x))
-    df2['Satisfaccion_NNA'] = df2['Satisfaccion_NNA'].apply(
-        lambda x: satMap(x))
-    
     # filling missing values
     df2 = df2.fillna(defaultMissingValue)
 
-    feedback_nna_output_path = output_paths.split(",")[-1]
+    if ("feedback_nna" in outputs):
+        writer.submit("feedback_nna", df=df2, fileType=output_format,
+                      exportName=outputs["feedback_nna"], compression=compression)
 
-    if (feedback_nna_output_path):
-        exportDataFrameToFile(df=df2, fileType=output_format,
-                              exportName=feedback_nna_output_path)
-        return
+    writer.wait()
 
     # database for Carto
     # if (bool(destination)):
@@ -499,10 +346,22 @@ if __name__ == "__main__":
     parser.add_argument('--destination', type=str,
                         help='A listCarto data warehouse endpoint')
     parser.add_argument('--output', type=str,
-                        help='A list of output names or output paths seperated by comma')
+                        help='Output names or output paths of the feedback and NNA feedback datasets seperated by comma, in that order or as feedback=path, feedback_nna=path')
+
+    parser.add_argument('--format', type=str, choices=export_formats,
+                        default='csv', help='Output format if output path is given')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip coordinates already geocoded by a previous interrupted run')
+
+    parser.add_argument('--panel', type=str,
+                        help='Output name or output path of the complete panel with every variable, not written if not given')
 
-    parser.add_argument('--format', type=str, choices=[
-                        'csv', 'json'], default='csv', help='Output format if output path is given')
+    parser.add_argument('--panel_format', type=str, choices=export_formats,
+                        default='xlsx', help='Output format of the complete panel')
+
+    parser.add_argument('--compression', type=str, choices=compressions,
+                        help='Compression of the output files: gzip or zstd for csv and ndjson, parquet and arrow are zstd compressed if not given')
 
     args = parser.parse_args()
 
@@ -511,8 +370,12 @@ if __name__ == "__main__":
     mon_path = args.mon_path
     info_path = args.info_path
     destinations = args.destination
-    output_paths = args.output
+    output_paths = args.output or ""
     output_format = args.format
+    resume = args.resume
+    compression = args.compression
+    panel_path = args.panel or ""
+    panel_format = args.panel_format
 
     if (not bool(cara_path)):
         print("Please add both Characterization data path")
@@ -530,9 +393,17 @@ if __name__ == "__main__":
         print("Please add both Information data path")
         sys.exit()
 
-    if ((not bool(output_paths)) & (not bool(destinations))):
+    if (not isCompressionSupported(output_format, compression)):
+        print(f"{output_format} files cannot be compressed with {compression}")
+        sys.exit()
+
+    if (not isCompressionSupported(panel_format, compression)):
+        print(f"{panel_format} files cannot be compressed with {compression}")
+        sys.exit()
+
+    if ((not bool(output_paths)) & (not bool(destinations)) & (not bool(panel_path))):
         print("Print add at least one output method")
         sys.exit()
 
     main(cara_path=cara_path, feedback_path=ayuda_path, monitoreo_path=mon_path, info_path=info_path, destinations=destinations,
-         output_paths=output_paths, output_format=output_format)
+         output_paths=output_paths, output_format=output_format, resume=resume, panel_path=panel_path, panel_format=panel_format, compression=compression)
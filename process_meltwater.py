@@ -3,11 +3,13 @@ import geopandas as gpd
 import os
 import re
 import json
-from datetime import datetime
 import math
 import numpy as np
 from shapely.geometry import Point
 import itertools
+from modules.custom_geo_functions import CountryGazetteer
+from modules.custom_time import parseTimestamps
+from modules.custom_io import writeGeoJson, iterFrameBatches
 
 
 MEDIA_SOURCES = [
@@ -164,25 +166,10 @@ def getTopPhrases(data):
         return {}
 
 
-def toUnixTimestamp(time):
-    start = datetime(1970, 1, 1)
-    target = datetime.strptime(time, "%Y-%m-%d")
-    in_seconds = (start - target).total_seconds()
-    in_milliseconds = int(in_seconds) * -1000
-    return in_milliseconds
-
-
-def timestampToString():
-    return lambda x: toUnixTimestamp(datetime.strptime(x, "%Y-%m-%dT%H:%M:%S.%fZ").strftime('%Y-%m-%d'))
-
-
-def applyFormatToDataframeColumn(df, column):
-    return df[column].apply(timestampToString())
-
-
 def getUniqueTimeSeries(data):
-    dates = applyFormatToDataframeColumn(
-        data, 'document_publish_date').unique().tolist()
+    # publish dates truncated to the day, in unix timestamp
+    dates = parseTimestamps(data['document_publish_date'], [
+                            "%Y-%m-%dT%H:%M:%S.%fZ"], unit="D")["timeunix"].unique().tolist()
     return dates
 
 
@@ -377,15 +364,22 @@ clean_countries_df["ISO_A2"] = clean_countries_df["ISO_A2"]
 
 clean_countries_df["ISO_A2_EH"] = clean_countries_df["ISO_A2_EH"]
 
-output_with_coords = gpd.GeoDataFrame(pd.merge(
-    left=output_df, right=clean_countries_df, how="left", left_on="country", right_on="ISO_A2"))
+# countries are resolved by their ISO code through the gazetteer index
+countries_gazetteer = CountryGazetteer(
+    clean_countries_df, name_column="ADMIN", code_columns=["ISO_A2", "ISO_A2_EH"])
+
+country_positions = countries_gazetteer.resolveColumn(output_df["country"])
+
+countries_gazetteer.report()
+
+output_with_coords = gpd.GeoDataFrame(pd.concat([output_df.reset_index(drop=True), countries_gazetteer.table.reindex(
+    country_positions).reset_index(drop=True)], axis=1))
 
 centre_point = Point(30.000062, 31.000062)
 
 output_with_coords["geometry"] = output_with_coords["geometry"].fillna(
     centre_point)
 
-json_df = output_with_coords.to_json()
-
-with open("output/processed_meltwater_data_v3_with_location.geojson", "w") as f:
-    f.write(json_df)
+# features are written in batches instead of building the whole GeoJSON string
+writeGeoJson(iterFrameBatches(output_with_coords),
+             "output/processed_meltwater_data_v3_with_location.geojson")
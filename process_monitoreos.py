@@ -1,25 +1,28 @@
 import sys
 import pandas as pd
-from pandas import merge, read_csv, to_datetime, DataFrame, concat
-from modules.custom_functions import toUnixTimestampMultiFormatted
+from pandas import merge, DataFrame, concat
+from modules.custom_csv import loadSchema, readCsvWithSchema
+from modules.custom_defaults import loadCompiledDefault
+from modules.custom_time import parseTimestamps, reportAmbiguous, interaction_formats
 from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame
-from modules.custom_io import useCartoAuth, uploadDataFrameToCarto, getCartoClient, exportDataFrameToFile, loadLocalJsonDoc
+from modules.custom_cache import GeocodeCache, GeocodeJournal
+from modules.custom_geocoder import getOfflineGeocoder
+from modules.custom_io import useCartoAuth, uploadDataFrameToCarto, uploadIncrementalToCarto, getCartoClient, exportDataFrameToFile, export_formats, compressions, isCompressionSupported
 from google.cloud import bigquery
 import os
 from argparse import ArgumentParser
 
 
-def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: str = "", output_path: str = "", output_format: str = "csv"):
+def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: str = "", output_path: str = "", output_format: str = "csv", resume: bool = False, incremental: bool = False, compression: str = None):
 
-    working_dir = os.getcwd()
-
-    # Import dataset
-    aurora_cara = read_csv(
-        filepath_or_buffer=cara_path)
-    aurora_feedback = read_csv(
-        filepath_or_buffer=feedback_path)
-    aurora_monitoreos = read_csv(
-        filepath_or_buffer=monitoreo_path)
+    # Import dataset, columns of the aurora exports are typed with defaults/aurora_schema.json
+    schema = loadSchema()
+    aurora_cara = readCsvWithSchema(
+        filepath=cara_path, schema=schema)
+    aurora_feedback = readCsvWithSchema(
+        filepath=feedback_path, schema=schema)
+    aurora_monitoreos = readCsvWithSchema(
+        filepath=monitoreo_path, schema=schema)
     # Merge tables of first connection
     aurora = merge(aurora_cara, aurora_feedback)
 
@@ -28,18 +31,18 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: s
 
     # Drop observations of Aurora team phones, test registers and geographical atypical rows
 
-    user_ids_to_remove = loadLocalJsonDoc(
-        os.path.join(working_dir, "defaults", "test_user_ids.json"))
+    user_ids_to_remove = loadCompiledDefault("test_user_ids.json")
 
-    for user_id in user_ids_to_remove:
-        aurora_comple = aurora_comple.drop(
-            aurora_comple[aurora_comple.UserId == user_id].index)
+    aurora_comple = aurora_comple[~aurora_comple.UserId.isin(user_ids_to_remove)]
 
-   # Variable of date in date format (for generating panel data)
-    aurora_comple["fecha"] = pd.to_datetime(
-        aurora_comple["Inicio interacción"],  errors='coerce', utc=True, infer_datetime_format=True).dt.strftime('%Y-%m-%d')
-    aurora_comple.loc[aurora_comple['fecha'] ==
-                      '2023-05-11', 'fecha'] = "2023-11-05"
+   # Variable of date in date format (for generating panel data) and time in unix timestamp
+    # day/month order comes from the format, so monitorings like 05/11/2023 are read as november 5th
+    interaction_times = parseTimestamps(
+        aurora_comple["Inicio interacción"], interaction_formats)
+    reportAmbiguous(aurora_comple["Inicio interacción"],
+                    interaction_times["ambiguous"])
+    aurora_comple["fecha"] = interaction_times["fecha"]
+    aurora_comple["timeunix"] = interaction_times["timeunix"]
 
     # Filling all observations of the same ID with the variable consent and actual country (variables of first connection)
     aurora_comple['País actual'] = aurora_comple.groupby(
@@ -93,24 +96,16 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: s
     # Creating the dataset for interactions across the route
 
     df = DataFrame(aurora_comple, columns=[
-        'UserId', 'Latitud', 'Longitud', 'Inicio interacción', 'Interaction_Sequence'])
-
-    possible_formats = ["%Y-%m-%d %H:%M:%S.%f+00:00",
-                        "%d/%m/%Y %H:%M:%S.%f+00:00"]
-
-    df["timeunix"] = df["Inicio interacción"].apply(
-        lambda x: toUnixTimestampMultiFormatted(time=str(x), formats=possible_formats))
+        'UserId', 'Latitud', 'Longitud', 'fecha', 'Interaction_Sequence', 'timeunix'])
     # renaming variables
     newColumns = {
         'UserId': 'id',
         'Latitud': 'lat',
         'Longitud': 'lon',
-        'Inicio interacción': 'date',
+        'fecha': 'date',
     }
 
     df = df.rename(columns=newColumns)
-    df["date"] = to_datetime(
-        df["date"], format='%Y-%m-%d %H:%M:%S', errors='coerce', utc=True).dt.strftime('%Y-%m-%d')
     # sortig by time
     df = df.sort_values(['id', 'timeunix'], ascending=[True, True])
     df['idx'] = df.groupby('id').cumcount()
@@ -131,8 +126,12 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: s
     MAPBOX_TOKEN = os.environ.get("MAPBOX_TOKEN")
     # This is heavy process that takes a while to finish
     # should be used sparingly and closer to end processes.
+    geocode_cache = GeocodeCache()
+    geocode_journal = GeocodeJournal(name="monitoreos", resume=resume)
     df = addReverseGeocodedToDataFrame(
-        df=df, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Monitoreo", id="id")
+        df=df, token=MAPBOX_TOKEN, lat_column="latitude", lon_column="longitude", name="Monitoreo", id="id", cache=geocode_cache, geocoder=getOfflineGeocoder(), journal=geocode_journal, precision=4)
+    geocode_cache.close()
+    geocode_journal.complete()
     # creating the structure of the variables pivoted
 
     df['lat_idx'] = 'lat_mon' + df['idx'].astype(str)
@@ -178,7 +177,7 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: s
 
     if (len(output_path) > 0):
         exportDataFrameToFile(df=reshape, fileType=output_format,
-                              exportName=output_path)
+                              exportName=output_path, compression=compression)
         return
 
     # database for Carto
@@ -192,8 +191,12 @@ def main(cara_path: str, feedback_path: str, monitoreo_path: str, destination: s
 
         config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE",)
 
-        uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
-                               destination=destination, config=config)
+        if (incremental):
+            uploadIncrementalToCarto(cartDW=carto_client, df=output_df,
+                                     destination=destination, config=config, key_column="id")
+        else:
+            uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
+                                   destination=destination, config=config)
         return
 
     print("No file was exported")
@@ -212,8 +215,17 @@ if __name__ == "__main__":
     parser.add_argument('--output', type=str,
                         help='Output name or output path')
 
-    parser.add_argument('--format', type=str, choices=[
-                        'csv', 'json'], default='csv', help='Output format if output path is given')
+    parser.add_argument('--format', type=str, choices=export_formats,
+                        default='csv', help='Output format if output path is given')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip coordinates already geocoded by a previous interrupted run')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help='Upload only the rows that are new or changed since the last upload, merged into the destination on id')
+
+    parser.add_argument('--compression', type=str, choices=compressions,
+                        help='Compression of the output files: gzip or zstd for csv and ndjson, parquet and arrow are zstd compressed if not given')
 
     args = parser.parse_args()
 
@@ -223,6 +235,9 @@ if __name__ == "__main__":
     destination = args.destination
     output_path = args.output
     output_format = args.format
+    resume = args.resume
+    compression = args.compression
+    incremental = args.incremental
 
     if (not bool(cara_path)):
         print("Please add both Characterization data path")
@@ -236,9 +251,13 @@ if __name__ == "__main__":
         print("Please add both Monitoring data path")
         sys.exit()
 
+    if (not isCompressionSupported(output_format, compression)):
+        print(f"{output_format} files cannot be compressed with {compression}")
+        sys.exit()
+
     if ((not bool(output_path)) & (not bool(destination))):
         print("Print add at least one output method")
         sys.exit()
 
     main(cara_path=cara_path, feedback_path=ayuda_path, monitoreo_path=mon_path, destination=destination,
-         output_path=output_path, output_format=output_format)
+         output_path=output_path, output_format=output_format, resume=resume, incremental=incremental, compression=compression)
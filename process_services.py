@@ -1,118 +1,52 @@
 import sys
 from argparse import ArgumentParser
-from pandas import read_csv
-import numpy as np
 import os
+from pandas import concat
 from google.cloud import bigquery
 
-from modules.custom_functions import replaceOrganisation, loadLocalJsonDoc, toUnixTimestamp, processMultValueColumns, processValueReplacement, capitaliseColumns
+from modules.custom_functions import multi_value_modes
+from modules.custom_plan import loadTransformationPlan
 from modules.custom_geo_functions import addReverseGeocodedToDataFrame, dataFrameToGeoDataFrame
+from modules.custom_cache import GeocodeCache, GeocodeJournal
+from modules.custom_geocoder import getOfflineGeocoder
 
-from modules.custom_io import uploadDataFrameToCarto, getCartoClient, useCartoAuth, exportDataFrameToFile
+from modules.custom_io import uploadDataFrameToCarto, uploadIncrementalToCarto, getCartoClient, useCartoAuth, exportDataFrameToFile, export_formats, compressions, isCompressionSupported
 
 
 defaultMissingValue = 999999
 
 
-def main(raw_data: str, destination: str = "", output_path: str = "", output_format: str = "csv"):
+def main(raw_data: str, destination: str = "", output_path: str = "", output_format: str = "csv", resume: bool = False, multi_value_mode: str = "codes", chunksize: int = 0, incremental: bool = False, compression: str = None):
 
-    working_dir = os.getcwd()
+    # replace, rename, drop and codification steps are described in defaults/services_plan.json
+    plan = loadTransformationPlan(
+        "services_plan.json", params={"multi_value_mode": multi_value_mode})
 
-    services = read_csv(raw_data, sep=';', index_col=False)
+    if (chunksize):
+        # raw rows are read and transformed a batch at a time, the transformed batches are joined for geocoding and export
+        with plan.readCsv(raw_data, chunksize=chunksize) as batches:
+            output_df = concat(plan.executeBatches(batches))
+    else:
+        services = plan.readCsv(raw_data)
 
-    # Replace "other in organizations"
-    services = replaceOrganisation(
-        services, 'otra', 'organizacionimplementadora', 'cualotraorganizacionimp')
-
-    services = replaceOrganisation(
-        services, 'otra', 'organizacionprincipal', 'cualotraorganizacionprin')
-
-    services = replaceOrganisation(
-        services, 'otra', 'organizacionpertence', 'cualotraorganizacionprin')
-
-    # Fill  missing values of variables of attended separated children
-    common = services['nnanoacompanados'].isnull()
-    common1 = services['nnaseparados'].isnull()
-    condition = [(services['numeronna'] == 0) & (common)]
-    condition1 = [(services['numeronna'] == 0) & (common1)]
-    fill_with = ['no']
-
-    services['nnanoacompanados'] = np.select(
-        condition, fill_with, default=services['nnanoacompanados'])
-    services['nnaseparados'] = np.select(
-        condition1, fill_with, default=services['nnaseparados'])
-
-    # keep the observations that were agreed with the informed consent
-    services = services[services['consentimiento'] != 'no']
-
-    # Renaming variables
-
-    # organizations name
-    organisation = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/organisation_names.json"))
-
-    # Implementor organisation
-    implemen_dict = organisation['implementors']
-    services['organizacionimplementadora'] = services['organizacionimplementadora'].replace(
-        implemen_dict)
-
-    # Principals organisation
-    principal_dict = organisation['principals']
-    services['organizacionprincipal'] = services['organizacionprincipal'].replace(
-        principal_dict)
-
-    # Places
-    places = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/places.json"))
-    # locals
-    places_dict = places['locals']
-    services['punto_reporte'] = services['punto_reporte'].replace(places_dict)
-
-    # countries
-    country_dict = places['countries']
-    services['pais'] = services['pais'].replace(country_dict)
-
-    # Columns
-    newColumns = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/rename_columns.json"))
-    services_carto = services.rename(columns=newColumns)
-
-    # Dropping two text variables related to final observations and scarce services
-    # (they are not needed in Carto, they are important on other analysis)
-    services_carto = services_carto.drop("observacion", axis='columns')
-    services_carto = services_carto.drop("serviciosescasos", axis='columns')
-
-    # serv_tipo (separating by pipe symbol and categorized with number)
-    codify_dict: dict = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/codification_dict.json"))
-
-    replace_lib = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/value_replacements.json"))
-    services_carto = processValueReplacement(services_carto, replace_lib)
-
-    _capitalise_columns = loadLocalJsonDoc(os.path.join(
-        working_dir, "defaults/column_capitalisation.json"))
-
-    services_carto = capitaliseColumns(services_carto, _capitalise_columns)
-
-    # parsing date field into unix timestamp
-    services_carto["timeunix"] = services_carto["fecha"].apply(
-        lambda x: toUnixTimestamp(time=x, format="%Y-%m-%d"))
-
-    output_df = processMultValueColumns(services_carto, codify_dict)
+        output_df = plan.execute(services)
 
     token = os.environ.get("MAPBOX_TOKEN")
 
     # add geo-administrative attributes
+    geocode_cache = GeocodeCache()
+    geocode_journal = GeocodeJournal(name="services", resume=resume)
     output_df = addReverseGeocodedToDataFrame(
-        output_df, lon_column="longitude", lat_column="latitude", token=token, name="Service data", id="id")
+        output_df, lon_column="longitude", lat_column="latitude", token=token, name="Service data", id="id", cache=geocode_cache, geocoder=getOfflineGeocoder(), journal=geocode_journal)
+    geocode_cache.close()
+    geocode_journal.complete()
 
     # Fill  missing values
     output_df = output_df.fillna(defaultMissingValue)
 
     if (len(output_path) > 0):
         exportDataFrameToFile(df=output_df, fileType=output_format,
-                              exportName=output_path)
+                              exportName=output_path, compression=compression)
         return
 
     if (bool(destination)):
@@ -125,8 +59,12 @@ def main(raw_data: str, destination: str = "", output_path: str = "", output_for
 
         config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE",)
 
-        uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
-                               destination=destination, config=config)
+        if (incremental):
+            uploadIncrementalToCarto(cartDW=carto_client, df=output_df,
+                                     destination=destination, config=config, key_column="id")
+        else:
+            uploadDataFrameToCarto(cartDW=carto_client, df=output_df,
+                                   destination=destination, config=config)
 
     print("No file was exported")
 
@@ -142,22 +80,46 @@ if __name__ == "__main__":
     parser.add_argument('--output', type=str,
                         help='Output path location')
 
-    parser.add_argument('--format', type=str, choices=[
-                        'csv', 'json'], default='csv', help='Output format if output path is given')
+    parser.add_argument('--format', type=str, choices=export_formats,
+                        default='csv', help='Output format if output path is given')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip coordinates already geocoded by a previous interrupted run')
+
+    parser.add_argument('--multi_value_mode', type=str, choices=multi_value_modes, default='codes',
+                        help='Encoding of multi-select columns: pipe-joined codes, bitmask or bitmask with sparse indicator columns')
+
+    parser.add_argument('--chunksize', type=int, default=0,
+                        help='Number of rows read and transformed at a time, the whole file is read at once if not given')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help='Upload only the rows that are new or changed since the last upload, merged into the destination on id')
+
+    parser.add_argument('--compression', type=str, choices=compressions,
+                        help='Compression of the output files: gzip or zstd for csv and ndjson, parquet and arrow are zstd compressed if not given')
 
     args = parser.parse_args()
     raw_data = args.file_path
     destination = args.destination
     output_path = args.output
     output_format = args.format
+    resume = args.resume
+    compression = args.compression
+    incremental = args.incremental
+    multi_value_mode = args.multi_value_mode
+    chunksize = args.chunksize
 
     if (not bool(raw_data)):
         print("Please add both raw data path")
         sys.exit()
 
+    if (not isCompressionSupported(output_format, compression)):
+        print(f"{output_format} files cannot be compressed with {compression}")
+        sys.exit()
+
     if ((not bool(output_path)) & (not bool(destination))):
         print("Print add at least one output method")
         sys.exit()
 
     main(raw_data=raw_data, destination=destination,
-         output_format=output_format, output_path=output_path)
+         output_format=output_format, output_path=output_path, resume=resume, multi_value_mode=multi_value_mode, chunksize=chunksize, incremental=incremental, compression=compression)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules package is imported from the repository root, as the process scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
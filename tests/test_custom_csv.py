@@ -0,0 +1,25 @@
+from pandas import read_csv
+from pandas.testing import assert_frame_equal
+from modules.custom_csv import readCsvWithSchema
+
+fixture = """UserId,Edad,Pais,Activo,Verificado,Extra,Codigo
+1,30,Perú,True,true,10,007
+2,,Chile,False,,x,
+3,41.5,NA,TRUE,false,12,011
+"""
+
+schema = {"UserId": "Int64", "Edad": "number", "Pais": "string",
+          "Activo": "number", "Verificado": "number"}
+
+
+def test_schema_reader_matches_read_csv(tmp_path):
+    filepath = tmp_path / "export.csv"
+    filepath.write_text(fixture, encoding="utf-8")
+    df = readCsvWithSchema(str(filepath), schema)
+    # "string" columns and columns that are not in the schema are kept as text
+    expected = read_csv(filepath, dtype={"UserId": "Int64", "Pais": str,
+                        "Extra": str, "Codigo": str})
+    assert_frame_equal(df, expected)
+    assert df["Activo"].dtype == bool
+    assert df["Verificado"].tolist()[::2] == [True, False]
+    assert df["Codigo"].tolist()[0] == "007"
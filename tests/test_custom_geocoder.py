@@ -0,0 +1,21 @@
+from geopandas import GeoDataFrame
+from shapely.geometry import box
+from modules.custom_geocoder import OfflineGeocoder
+
+
+def test_regions_are_matched_within_the_country_of_the_point(tmp_path):
+    admin0_path = str(tmp_path / "admin0.geojson")
+    admin1_path = str(tmp_path / "admin1.geojson")
+    GeoDataFrame({"ADMIN": ["Colombia", "Venezuela"], "ISO_A2_EH": ["CO", "VE"]},
+                 geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)], crs="EPSG:4326").to_file(admin0_path, driver="GeoJSON")
+    # the boundary of the colombian region is less precise and crosses the border
+    GeoDataFrame({"name": ["Norte de Santander", "Táchira"], "iso_a2": ["CO", "VE"]},
+                 geometry=[box(0, 0, 1.1, 1), box(1, 0, 2, 1)], crs="EPSG:4326").to_file(admin1_path, driver="GeoJSON")
+    geocoder = OfflineGeocoder(admin0_path, admin1_path)
+
+    colombia, venezuela, outside = geocoder.reverseGeocodeMany(
+        [(0.5, 0.5), (1.05, 0.5), (5, 5)])
+    assert colombia["region_name"] == "Norte de Santander, Colombia"
+    assert venezuela["country_name"] == "Venezuela"
+    assert venezuela["region_name"] == "Táchira, Venezuela"
+    assert outside is None
@@ -0,0 +1,77 @@
+import pytest
+import numpy as np
+import pandas as pd
+from google.cloud.bigquery import LoadJobConfig
+import modules.custom_io as custom_io
+from modules.custom_cache import UploadManifest
+from modules.custom_io import CartoUploader, LocalLoadClient, LocalLoadJob, uploadIncrementalToCarto, exportDataFrameToFile, isCompressionSupported
+
+
+class MergeClient(LocalLoadClient):
+    """
+    local client that records the schema of the staging table of every MERGE statement
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.merged = []
+
+    def query(self, query: str):
+        staging = query.split("USING `")[1].split("`")[0]
+        self.merged.append(self.tables[staging][0].schema)
+        return LocalLoadJob("merge", 0)
+
+
+def test_incremental_upload_uses_the_types_of_the_whole_frame(tmp_path, monkeypatch):
+    monkeypatch.setattr(custom_io, "UploadManifest",
+                        lambda destination: UploadManifest(destination, directory=str(tmp_path)))
+    df = pd.DataFrame({"id": np.arange(4), "label": [999999, 999999, "Agua", "Luz"],
+                       "value": [1.0, 2.0, 3.0, 4.0]})
+    client = MergeClient()
+    config = LoadJobConfig(write_disposition="WRITE_TRUNCATE")
+    uploadIncrementalToCarto(client, df, "p.d.t", config, key_column="id")
+
+    # only rows holding the numeric fill value change
+    changed = df.copy()
+    changed.loc[[0, 1], "value"] = [10.0, 20.0]
+    uploadIncrementalToCarto(client, changed, "p.d.t", config, key_column="id")
+
+    destination = client.tables["p.d.t"][0].schema
+    assert len(client.merged) == 1
+    assert client.merged[0].field("label").type == destination.field("label").type
+    assert client.merged[0].field("label").type == "string"
+
+
+def test_empty_frames_keep_their_header(tmp_path):
+    df = pd.DataFrame({"id": pd.Series([], dtype="int64"),
+                      "country": pd.Series([], dtype=object)})
+    for compression, extension in [(None, ".csv"), ("gzip", ".csv.gz")]:
+        name = exportDataFrameToFile(
+            df, "csv", str(tmp_path / "empty"), compression=compression)
+        assert name.endswith(extension)
+        assert list(pd.read_csv(name).columns) == ["id", "country"]
+    name = exportDataFrameToFile(df, "xlsx", str(tmp_path / "empty"))
+    assert list(pd.read_excel(name).columns) == ["id", "country"]
+
+
+def test_unsupported_compression_is_rejected_before_writing(tmp_path):
+    df = pd.DataFrame({"id": [1, 2]})
+    assert not isCompressionSupported("arrow", "gzip")
+    with pytest.raises(ValueError):
+        exportDataFrameToFile(df, "arrow", str(tmp_path / "out"), compression="gzip")
+    assert not (tmp_path / "out.arrow").exists()
+
+
+def test_truncating_upload_of_an_empty_frame_empties_the_destination():
+    client = LocalLoadClient()
+    config = LoadJobConfig(write_disposition="WRITE_TRUNCATE")
+    df = pd.DataFrame({"id": np.arange(3), "label": ["a", "b", "c"]})
+    CartoUploader(client, chunk_rows=2).upload(df, "p.d.t", config)
+    assert len(client.getTable("p.d.t")) == 3
+
+    metrics = CartoUploader(client).upload(df.iloc[:0], "p.d.t", config)
+    table = client.getTable("p.d.t")
+    assert metrics["rows"] == 0
+    assert len(table) == 0
+    assert list(table.columns) == ["id", "label"]
+    assert list(client.tables) == ["p.d.t"]